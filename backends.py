@@ -0,0 +1,143 @@
+import abc
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Địa chỉ Redis (hoặc dịch vụ tương thích) dùng chung giữa các process; bỏ trống thì dùng bộ nhớ trong process
+REDIS_URL = os.getenv('REDIS_URL')
+# Tiền tố cho mọi khóa, để nhiều bot dùng chung một Redis không đụng nhau
+BACKEND_PREFIX = os.getenv('BACKEND_PREFIX', 'tbcn:')
+
+
+# Giao diện backend dùng chung cho hàng đợi job, cache file_id media và cache sản phẩm.
+# Giá trị là dữ liệu JSON được (dict, list, str, số).
+class Backend(abc.ABC):
+    # True nếu nhiều process nhìn thấy cùng dữ liệu
+    shared = False
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Any:
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ...
+
+    # Ghi nếu khóa chưa tồn tại; dùng làm khóa phân tán. Trả về True nếu ghi được.
+    @abc.abstractmethod
+    async def set_if_absent(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def push(self, queue: str, item: Any) -> None:
+        ...
+
+    # Lấy phần tử đầu hàng đợi, chờ tối đa timeout giây; None nếu hết thời gian
+    @abc.abstractmethod
+    async def pop(self, queue: str, timeout: float = 1) -> Any:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+# Backend trong bộ nhớ của một process (mặc định, giữ hành vi khi chỉ chạy một instance)
+class MemoryBackend(Backend):
+    def __init__(self):
+        self._data: Dict[str, Tuple[Optional[float], Any]] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+
+    def _alive(self, key: str) -> bool:
+        item = self._data.get(key)
+        if item is None:
+            return False
+        expires_at = item[0]
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return False
+        return True
+
+    async def get(self, key: str) -> Any:
+        return self._data[key][1] if self._alive(key) else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.monotonic() + ttl if ttl else None, value)
+
+    async def set_if_absent(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        if self._alive(key):
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def _queue(self, queue: str) -> asyncio.Queue:
+        q = self._queues.get(queue)
+        if q is None:
+            q = self._queues[queue] = asyncio.Queue()
+        return q
+
+    async def push(self, queue: str, item: Any) -> None:
+        self._queue(queue).put_nowait(item)
+
+    async def pop(self, queue: str, timeout: float = 1) -> Any:
+        try:
+            return await asyncio.wait_for(self._queue(queue).get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# Backend Redis dùng chung giữa nhiều process/container. Nhận sẵn client tương thích
+# redis.asyncio (ví dụ fakeredis khi chạy thử cục bộ) hoặc tạo client từ URL.
+class RedisBackend(Backend):
+    shared = True
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = BACKEND_PREFIX):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Any:
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    async def set_if_absent(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        return bool(await self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None, nx=True))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    async def push(self, queue: str, item: Any) -> None:
+        await self.client.rpush(self.prefix + queue, json.dumps(item))
+
+    async def pop(self, queue: str, timeout: float = 1) -> Any:
+        result = await self.client.blpop([self.prefix + queue], timeout=timeout)
+        return None if result is None else json.loads(result[1])
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def create_backend(url: Optional[str] = REDIS_URL) -> Backend:
+    if url:
+        logger.info('Using Redis backend at %s', url.split('@')[-1])
+        return RedisBackend(url)
+    return MemoryBackend()
+
+
+backend = create_backend()
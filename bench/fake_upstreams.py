@@ -0,0 +1,184 @@
+import asyncio
+import io
+import json
+import os
+import random
+import struct
+import time
+
+from aiohttp import web
+from PIL import Image
+
+# Dịch vụ giả lập cho benchmark, chạy trong một process riêng:
+# - /sheet: API tra cứu mã kiện hàng với N dòng
+# - /api_tb, /api2_tb, /api_pdd: API sản phẩm, trả về danh sách URL media trên CDN giả
+# - /cdn/...: ảnh JPEG (hoặc video) với kích thước và độ trễ cấu hình được
+# - /bot<token>/<method>: Telegram Bot API, ghi lại thời điểm gửi tin cho từng chat; nhận cả media dạng
+#   file:// như server Bot API tự host ở chế độ --local (tệp phải tồn tại)
+# - /_stats: số liệu phía Telegram giả để benchmark tính độ trễ đầu-cuối
+
+
+def tracking_code(i: int) -> str:
+    return f'TRK{i:012d}'
+
+
+def make_sheet(rows: int) -> bytes:
+    return json.dumps([
+        {'tracking': tracking_code(i), 'rec': i % 3 == 0, 'sl': i % 5 + 1, 'var': f'Màu {i % 7}', 'imgurl': f'https://img.example.com/{i}_200x200.jpg'}
+        for i in range(rows)
+    ]).encode()
+
+
+# Ảnh JPEG khác nhau theo seed (để bước bỏ ảnh gần trùng không gộp chúng), trộn thêm nhiễu
+# để dung lượng gần với ảnh sản phẩm thật hơn ảnh một màu
+def make_image(side: int, quality: int = 90, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    pattern = Image.frombytes('RGB', (8, 8), bytes(rng.randrange(256) for _ in range(8 * 8 * 3))).resize((side, side), Image.BICUBIC)
+    noise = Image.effect_noise((side, side), 64).convert('RGB')
+    buffer = io.BytesIO()
+    Image.blend(pattern, noise, 0.3).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def _box(box_type: bytes, body: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+
+# Tệp MP4 tối thiểu: dữ liệu ngẫu nhiên trong mdat, moov ở cuối tệp với thời lượng và kích thước khung hình
+def make_video(size: int, duration: int = 15, width: int = 720, height: int = 720) -> bytes:
+    mvhd = _box(b'mvhd', bytes(12) + struct.pack('>II', 1000, duration * 1000) + bytes(80))
+    tkhd = _box(b'tkhd', bytes(76) + struct.pack('>II', width << 16, height << 16))
+    return _box(b'ftyp', b'isom' + bytes(4)) + _box(b'mdat', os.urandom(size)) + _box(b'moov', mvhd + _box(b'trak', tkhd))
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.message_id = 0
+        self.file_id = 0
+        # chat_id -> [số tin, thời điểm tin cuối, số byte nhận được, nội dung tin văn bản cuối]
+        self.chats = {}
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self.message_id += 1
+        return dict({'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}, **extra)
+
+    def _file(self, **extra) -> dict:
+        self.file_id += 1
+        return dict({'file_id': f'file{self.file_id}', 'file_unique_id': f'u{self.file_id}'}, **extra)
+
+    def _record(self, chat_id: int, size: int, text=None) -> None:
+        chat = self.chats.setdefault(chat_id, [0, 0.0, 0, None])
+        chat[0] += 1
+        chat[1] = time.time()
+        chat[2] += size
+        if text is not None:
+            chat[3] = text
+
+    # Các media gửi bằng đường dẫn file:// trong một request
+    @staticmethod
+    def _file_uris(method: str, form) -> list:
+        if method == 'sendMediaGroup':
+            values = [item['media'] for item in json.loads(form['media'])]
+        else:
+            values = [form.get('video'), form.get('photo')]
+        return [value for value in values if isinstance(value, str) and value.startswith('file://')]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        form = await request.post()
+        size = request.content_length or 0
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+        missing = [uri for uri in self._file_uris(method, form) if not os.path.exists(uri[len('file://'):])]
+        if missing:
+            return web.json_response({'ok': False, 'error_code': 400, 'description': f'Bad Request: file not found {missing[0]}'}, status=400)
+        chat_id = int(form.get('chat_id', 0))
+        if method == 'sendMessage':
+            self._record(chat_id, size, form.get('text'))
+            return self._ok(self._message(chat_id, text=form.get('text')))
+        if method == 'sendMediaGroup':
+            items = json.loads(form['media'])
+            if any('media' not in item for item in items):
+                return web.json_response({'ok': False, 'error_code': 400, 'description': 'Bad Request: media not found'}, status=400)
+            self._record(chat_id, size)
+            messages = []
+            for item in items:
+                if item['type'] == 'video':
+                    messages.append(self._message(chat_id, video=self._file(width=720, height=720, duration=10)))
+                else:
+                    messages.append(self._message(chat_id, photo=[self._file(width=1280, height=1280)]))
+            return self._ok(messages)
+        if method == 'sendVideo':
+            self._record(chat_id, size)
+            return self._ok(self._message(chat_id, video=self._file(width=720, height=720, duration=10)))
+        if method == 'sendPhoto':
+            self._record(chat_id, size)
+            return self._ok(self._message(chat_id, photo=[self._file(width=1280, height=1280)]))
+        return web.json_response({'ok': False, 'error_code': 400, 'description': f'Unsupported method {method}'}, status=400)
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+
+def create_app(config: dict) -> web.Application:
+    base = config['base_url']
+    media = config.get('media_per_listing', 10)
+    videos = config.get('videos_per_listing', 0)
+    cdn_latency = config.get('cdn_latency', 0.02)
+    api_latency = config.get('api_latency', 0.05)
+    images = [make_image(config.get('image_side', 800), config.get('image_quality', 90), seed) for seed in range(max(media, 1))]
+    video = make_video(config.get('video_bytes', 512 * 1024), config.get('video_seconds', 15))
+    sheet = make_sheet(config.get('sheet_rows', 1000))
+    telegram = FakeTelegram()
+
+    def media_urls(product: str) -> list:
+        return [f'{base}/cdn/{product}/v{i}.mp4' for i in range(videos)] + [f'{base}/cdn/{product}/{i}.jpg' for i in range(media)]
+
+    async def get_sheet(request: web.Request) -> web.Response:
+        await asyncio.sleep(api_latency)
+        return web.Response(body=sheet, content_type='application/json', headers={'ETag': f'"{len(sheet)}"'})
+
+    async def api_tb(request: web.Request) -> web.Response:
+        product = (await request.json())['id']
+        await asyncio.sleep(api_latency)
+        urls = media_urls(f'tb{product}')
+        half = len(urls) // 2
+        return web.json_response({'video': [], 'images': [{'url': url} for url in urls[:half]], 'skubaseImages': []})
+
+    async def api2_tb(request: web.Request) -> web.Response:
+        product = (await request.json())['id']
+        await asyncio.sleep(api_latency)
+        urls = media_urls(f'tb{product}')
+        return web.json_response({'descVideos': [], 'descImages': [{'url': url} for url in urls[len(urls) // 2:]]})
+
+    async def api_pdd(request: web.Request) -> web.Response:
+        link = (await request.json())['linksp']
+        await asyncio.sleep(api_latency)
+        return web.json_response({'topGallery': media_urls('pdd' + link.rsplit('=', 1)[-1])})
+
+    async def cdn(request: web.Request) -> web.Response:
+        await asyncio.sleep(cdn_latency)
+        # Thêm đuôi theo URL sau dữ liệu để mỗi tệp có hash nội dung khác nhau như media thật
+        if request.path.endswith('.mp4'):
+            return web.Response(body=video + request.path.encode(), content_type='video/mp4')
+        index = int(request.path.rsplit('/', 1)[-1].split('.')[0])
+        return web.Response(body=images[index % len(images)] + request.path.encode(), content_type='image/jpeg')
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({'chats': telegram.chats, 'image_bytes': len(images[0])})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get('/sheet', get_sheet)
+    app.router.add_post('/api_tb', api_tb)
+    app.router.add_post('/api2_tb', api2_tb)
+    app.router.add_post('/api_pdd', api_pdd)
+    app.router.add_get('/cdn/{path:.*}', cdn)
+    app.router.add_post('/bot{token}/{method}', telegram.handle)
+    app.router.add_get('/_stats', stats)
+    return app
+
+
+def serve(port: int, config: dict) -> None:
+    config = dict(config, base_url=f'http://127.0.0.1:{port}')
+    web.run_app(create_app(config), host='127.0.0.1', port=port, print=None, access_log=None)
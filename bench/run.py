@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import fake_upstreams
+
+# Benchmark chạy mã thật của bot (handle_message -> job -> tải media -> gửi Telegram) với các dịch vụ giả
+# trong fake_upstreams.py. Mỗi kịch bản chạy trong một process riêng để đo RSS đỉnh độc lập.
+#
+#   python bench/run.py                                  # chạy mọi kịch bản, in bảng kết quả
+#   python bench/run.py -s pdd-10 -s tracking-100k       # chỉ chạy một số kịch bản
+#   python bench/run.py --save-baseline bench/baseline.json
+#   python bench/run.py --baseline bench/baseline.json   # thoát với mã 1 nếu chậm hơn baseline quá ngưỡng
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '123456:BENCH'
+# Thời gian tối đa chờ process dịch vụ giả sẵn sàng
+UPSTREAMS_START_TIMEOUT = 120
+
+# kind: loại tin nhắn gửi vào bot; requests: số tin; rate: số tin/giây (0 = gửi cùng lúc)
+SCENARIOS = {
+    'tracking-1k': {'kind': 'tracking', 'requests': 500, 'rate': 0, 'sheet_rows': 1000},
+    'tracking-100k': {'kind': 'tracking', 'requests': 500, 'rate': 0, 'sheet_rows': 100000},
+    'pdd-10': {'kind': 'pdd', 'requests': 40, 'rate': 0, 'media_per_listing': 10},
+    'pdd-200': {'kind': 'pdd', 'requests': 4, 'rate': 0, 'media_per_listing': 200},
+    'taobao-10': {'kind': 'taobao', 'requests': 20, 'rate': 0, 'media_per_listing': 10},
+    'pdd-10-large-images': {'kind': 'pdd', 'requests': 10, 'rate': 0, 'media_per_listing': 10, 'image_side': 3000},
+    'pdd-10-videos': {'kind': 'pdd', 'requests': 10, 'rate': 0, 'media_per_listing': 10, 'videos_per_listing': 2, 'video_bytes': 12 * 1024 * 1024},
+    # Như pdd-10-videos nhưng qua server Bot API tự host ở chế độ --local: media trong cache được gửi bằng đường dẫn
+    'pdd-10-videos-local-api': {'kind': 'pdd', 'requests': 10, 'rate': 0, 'media_per_listing': 10, 'videos_per_listing': 2,
+                                'video_bytes': 12 * 1024 * 1024, 'bot_api_local': True},
+}
+
+# Chỉ số dùng để so với baseline: True nếu giá trị lớn hơn là tốt hơn
+GATED_METRICS = {'p95': False, 'msgs_per_sec': True, 'rss_peak_mb': False, 'disk_peak_mb': False}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def message_text(kind: str, i: int, config: dict) -> str:
+    if kind == 'tracking':
+        # Khoảng 1/10 mã không có trong sheet
+        rows = config.get('sheet_rows', 1000)
+        return fake_upstreams.tracking_code((i * 7919) % (rows + rows // 10))
+    if kind == 'taobao':
+        return f'https://item.taobao.com/item.htm?id={100000 + i}'
+    return f'https://mobile.yangkeduo.com/goods.html?goods_id={100000 + i}'
+
+
+# Chạy một kịch bản trong process hiện tại; trả về dict kết quả
+def run_scenario(name: str, config: dict) -> dict:
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    upstreams = multiprocessing.Process(target=fake_upstreams.serve, args=(port, config), daemon=True)
+    upstreams.start()
+
+    work_dir = tempfile.mkdtemp(prefix='tbcn-bench-')
+    tmp_dir = os.path.join(work_dir, 'tmp')
+    cache_dir = os.path.join(work_dir, 'cache')
+    os.makedirs(tmp_dir)
+    # Cấu hình cho bot trước khi import; giới hạn gửi tin được nới vì Telegram giả không giới hạn
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'API_URL': f'{base}/sheet',
+        'API_TB': f'{base}/api_tb',
+        'API2_TB': f'{base}/api2_tb',
+        'API_PDD': f'{base}/api_pdd',
+        'MEDIA_CACHE_DIR': cache_dir,
+        'TRACKING_DB': os.path.join(work_dir, 'tracking.db'),
+        'CACHE_SNAPSHOT': os.path.join(work_dir, 'snapshot.json'),
+        'METRICS_PORT': '0',
+        'LOG_LEVEL': 'WARNING',
+        'SEND_GLOBAL_RATE': '100000',
+        'SEND_GLOBAL_BURST': '100000',
+        'SEND_CHAT_RATE': '100000',
+        'SEND_CHAT_BURST': '100000',
+    })
+    os.environ.pop('REDIS_URL', None)
+    if config.get('bot_api_local'):
+        os.environ.update({'BOT_API_URL': base, 'BOT_API_LOCAL_MODE': '1'})
+    tempfile.tempdir = tmp_dir
+    sys.path.insert(0, ROOT)
+    try:
+        return asyncio.run(_run(name, config, base, work_dir))
+    finally:
+        upstreams.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def _run(name: str, config: dict, base: str, work_dir: str) -> dict:
+    from telegram import Bot, Update
+    from telegram.request import HTTPXRequest
+
+    import bot
+
+    # Chờ dịch vụ giả sẵn sàng; tạo nhiều ảnh mẫu (ví dụ pdd-200) mất hơn chục giây
+    async with httpx.AsyncClient() as client:
+        deadline = time.monotonic() + UPSTREAMS_START_TIMEOUT
+        while True:
+            try:
+                await client.get(f'{base}/_stats')
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Fake upstreams did not start within {UPSTREAMS_START_TIMEOUT:.0f} s')
+                await asyncio.sleep(0.05)
+
+    tg = Bot(TOKEN, base_url=f'{base}/bot', local_mode=config.get('bot_api_local', False), request=HTTPXRequest(connection_pool_size=512, read_timeout=60, write_timeout=60, media_write_timeout=60))
+    await tg.initialize()
+
+    class Application:
+        bot_data = {}
+    application = Application()
+    application.bot = tg
+    await bot.post_init(application)
+
+    disk_peak = 0
+    sampling = True
+
+    async def sample_disk() -> None:
+        nonlocal disk_peak
+        while sampling:
+            disk_peak = max(disk_peak, dir_size(work_dir))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.ensure_future(sample_disk())
+    kind = config['kind']
+    rate = config.get('rate', 0)
+    started = {}
+    begin = time.time()
+    for i in range(config['requests']):
+        chat_id = i + 1
+        update = Update.de_json({
+            'update_id': chat_id,
+            'message': {
+                'message_id': chat_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+                'text': message_text(kind, i, config),
+            },
+        }, tg)
+        started[chat_id] = time.time()
+        await bot.handle_message(update, None)
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await bot.job_scheduler.drain(timeout=600)
+    sampling = False
+    await sampler
+
+    async with httpx.AsyncClient() as client:
+        stats = (await client.get(f'{base}/_stats')).json()
+    await bot.post_stop(application)
+    await tg.shutdown()
+    await bot.post_shutdown(application)
+
+    chats = {int(chat_id): chat for chat_id, chat in stats['chats'].items()}
+    latencies = [chats[chat_id][1] - start for chat_id, start in started.items() if chat_id in chats]
+    end = max((chat[1] for chat in chats.values()), default=begin)
+    messages = sum(chat[0] for chat in chats.values())
+    errors = sum(1 for chat in chats.values() if chat[3] and ('lỗi' in chat[3] or 'Không thể' in chat[3] or 'Failed' in chat[3]))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'scenario': name,
+        'requests': len(started),
+        'errors': errors + len(started) - len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'wall': end - begin,
+        'msgs_per_sec': messages / max(end - begin, 1e-9),
+        'upload_mb': sum(chat[2] for chat in chats.values()) / 1024 ** 2,
+        'rss_peak_mb': usage.ru_maxrss / 1024,
+        'disk_peak_mb': disk_peak / 1024 ** 2,
+    }
+
+
+def run_child(name: str, overrides: dict) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--overrides', json.dumps(overrides)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_table(results: list) -> None:
+    header = f"{'scenario':<22}{'req':>5}{'err':>5}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'msg/s':>9}{'up MB':>9}{'RSS MB':>9}{'disk MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<22}{r['requests']:>5}{r['errors']:>5}{r['p50']:>8.2f}{r['p95']:>8.2f}{r['p99']:>8.2f}"
+              f"{r['msgs_per_sec']:>9.1f}{r['upload_mb']:>9.1f}{r['rss_peak_mb']:>9.1f}{r['disk_peak_mb']:>9.1f}")
+
+
+# So kết quả với baseline; trả về danh sách mô tả các chỉ số bị chậm/tệ hơn quá ngưỡng
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for r in results:
+        base = baseline.get(r['scenario'])
+        if base is None:
+            continue
+        if r['errors'] > base.get('errors', 0):
+            regressions.append(f"{r['scenario']}: errors {base.get('errors', 0)} -> {r['errors']}")
+        for metric, higher_is_better in GATED_METRICS.items():
+            old, new = base.get(metric), r[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{r['scenario']}: {metric} {old:.2f} -> {new:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot against fake upstreams')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS), help='scenario to run (default: all)')
+    parser.add_argument('--requests', type=int, help='override the number of requests per scenario')
+    parser.add_argument('--cdn-latency', type=float, help='fake CDN latency per file in seconds')
+    parser.add_argument('--api-latency', type=float, help='fake product/sheet API latency in seconds')
+    parser.add_argument('--baseline', help='JSON baseline to gate regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+    parser.add_argument('--save-baseline', help='write the results as a new baseline')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--overrides', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        config = dict(SCENARIOS[args.child], **json.loads(args.overrides))
+        print(json.dumps(run_scenario(args.child, config)))
+        return
+
+    overrides = {}
+    if args.requests:
+        overrides['requests'] = args.requests
+    if args.cdn_latency is not None:
+        overrides['cdn_latency'] = args.cdn_latency
+    if args.api_latency is not None:
+        overrides['api_latency'] = args.api_latency
+
+    results = [run_child(name, overrides) for name in (args.scenario or SCENARIOS)]
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({r['scenario']: r for r in results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,63 @@
+import time
+# Thời điểm process bắt đầu import, dùng để đo thời gian khởi động tới khi sẵn sàng nhận update
+PROCESS_STARTED_AT = time.monotonic()
 import logging
 import os
 import re
 import asyncio
-import tempfile
 import shutil
-from PIL import Image
-from telegram import Update, InputMediaPhoto, InputMediaVideo
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import CommandHandler, MessageHandler, filters, CallbackContext, ApplicationBuilder
-import requests
-import json
-import time
-from urllib.parse import urlparse
+from backends import backend
+from bot_api import bot_api
+from cache_snapshot import CACHE_SNAPSHOT_INTERVAL, cache_snapshot
+from http_client import http_client
+from image_transcode import image_transcoder
+from jobs import job_scheduler
+from marketplaces import Link, ProductFetchError, registry as marketplaces, resolve_cache, resolve_link
+from media_cache import media_cache
+from media_pipeline import dedupe_media_urls, input_media, media_input, refetch_without_file_ids, remember_sent, stream_media_groups, video_options
+from metrics import JOBS_PENDING, JOBS_RUNNING, READY, STAGE_SECONDS, STARTUP_SECONDS, log_sampled, start_metrics_server
+from sender import send_scheduler
+from tracking_history import TRACKING_SYNC_INTERVAL, SubscriptionLimitError, TrackingHistory
+from tracking_store import TrackingStore, TrackingFetchError
+from ttl_cache import TTLCache
 
 # Lấy bot token và API URL từ biến môi trường
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Chế độ nhận update: 'polling' (mặc định) hoặc 'webhook' (xem webhook.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Vai trò của process khi chạy nhiều instance với REDIS_URL: 'all' (nhận update và xử lý job),
+# 'ingress' (chỉ nhận update rồi đẩy vào hàng đợi chung) hoặc 'worker' (chỉ xử lý job từ hàng đợi chung)
+BOT_ROLE = os.getenv('BOT_ROLE', 'all')
+# Tên hàng đợi job dùng chung trong backend
+JOB_QUEUE = 'jobs'
+# Thời gian giữ dấu link mới nhất của mỗi chat, dùng để bỏ các link cũ bị thay thế
+LATEST_LINK_TTL = 3600
 API_URL = os.getenv('API_URL')
-API_TB = os.getenv('API_TB')
-API2_TB = os.getenv('API2_TB')
-API_PDD = os.getenv('API_PDD')
+# Số ký tự tối đa của một tin nhắn Telegram
+MAX_MESSAGE_LENGTH = 4096
+PRODUCT_CACHE_TTL = float(os.getenv('PRODUCT_CACHE_TTL', '1800'))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', '1000'))
+# Ngân sách thời gian (giây) từ lúc process bắt đầu tới khi sẵn sàng; warm-up chưa xong khi hết ngân sách tiếp tục chạy nền
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', '15'))
+
+# Kho tra cứu mã kiện hàng dùng chung, tải sheet một lần và làm mới theo TTL
+tracking_store = TrackingStore(API_URL)
+# Các mã kiện hàng người dùng theo dõi, được đồng bộ định kỳ với sheet để báo khi trạng thái thay đổi
+tracking_history = TrackingHistory()
+
+# Cache dữ liệu sản phẩm từ API của các sàn (xem marketplaces.py), các yêu cầu đồng thời cho cùng sản phẩm dùng chung một lượt gọi
+product_cache = TTLCache(PRODUCT_CACHE_TTL, PRODUCT_CACHE_SIZE, backend=backend, namespace='product:', name='product')
+
+# Các cache được ghi vào ảnh chụp khi tắt và nạp lại khi khởi động (xem cache_snapshot.py)
+cache_snapshot.register('tracking', tracking_store.dump, lambda data, elapsed: tracking_store.load(data))
+cache_snapshot.register('product', product_cache.dump, product_cache.load)
+cache_snapshot.register('shortlink', resolve_cache.dump, resolve_cache.load)
 
 # Thiết lập logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 # Thiết lập mức độ log cho thư viện httpx
@@ -28,27 +65,26 @@ logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # Hàm khởi đầu khi bắt đầu bot
 async def start(update: Update, context: CallbackContext) -> None:
-    await get_reply_func(update)('Xin chào! Hãy gửi mã kiện hàng của bạn để tôi tra cứu.')
+    await get_reply_func(update)('Xin chào! Hãy gửi mã kiện hàng của bạn để tôi tra cứu.\n'
+                                 'Dùng /theodoi <mã> để nhận thông báo khi trạng thái kiện hàng thay đổi.')
     logging.info('Bot started.')
 
-# Hàm lấy hàm phản hồi phù hợp dựa trên loại tin nhắn
+# Hàm lấy hàm phản hồi phù hợp dựa trên loại tin nhắn, mọi lượt gửi đi qua bộ lập lịch gửi tin
 def get_reply_func(update: Update):
     if hasattr(update, 'business_message') and update.business_message:
-        return update.business_message.reply_text
+        return send_scheduler.bind(update.effective_chat.id, update.business_message.reply_text)
     elif hasattr(update, 'message') and update.message:
-        return update.message.reply_text
+        return send_scheduler.bind(update.effective_chat.id, update.message.reply_text)
 
 def get_reply_media_group_func(update: Update):
     if hasattr(update, 'business_message') and update.business_message:
-        return update.business_message.reply_media_group
+        return send_scheduler.bind(update.effective_chat.id, update.business_message.reply_media_group)
     elif hasattr(update, 'message') and update.message:
-        return update.message.reply_media_group
+        return send_scheduler.bind(update.effective_chat.id, update.message.reply_media_group)
 
 # Hàm xử lý tin nhắn nhận được
 async def handle_message(update: Update, context: CallbackContext) -> None:
     reply_func = get_reply_func(update)
-    reply_media_group_func = get_reply_media_group_func(update)
-    reply_video_func = get_reply_video_func(update)
     message_text = None
 
     # Kiểm tra và xử lý tin nhắn từ tài khoản business
@@ -67,211 +103,284 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         message_text = message_text.strip()
         await reply_func("Đang phân tích liên kết...")
 
-        if message_text.startswith('https://item.taobao.com/'):
-            taobao_id = extract_taobao_id(message_text)
-            if taobao_id:
-                url = API_TB
-                url2 = API2_TB
-                payload = {'id': taobao_id}
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-                if response.status_code == 200:
-                    data = response.json()
-                    time.sleep(3)
-                    response2 = requests.post(url2, headers=headers, data=json.dumps(payload))
-                    if response2.status_code == 200:
-                        data2 = response2.json()
-                        logger.info(data2)
-                        img_urls = data.get('video', []) + data2.get('descVideos', []) + data.get('images', []) + data.get('skubaseImages', []) + data2.get('descImages', [])
-                        logger.info(img_urls)
-                        cleaned_urls = list(set(clean_image_url(img['url']) for img in img_urls if 'url' in img))
-                        if cleaned_urls:
-                            await download_and_send_media(update, cleaned_urls, reply_func, reply_video_func, reply_media_group_func)
-                        else:
-                            await reply_func('Không tìm thấy URL ảnh hợp lệ.')
-                    else:
-                        await reply_func('Failed to fetch image desc.')
-                else:
-                    await reply_func('Failed to fetch image details.')
-            else:
-                await reply_func('Invalid Taobao link format.')
-        
-        elif message_text.startswith('https://mobile.yangkeduo.com/'):
-            pattern = re.compile(r'goods\d*\.html')
-            if pattern.search(message_text):
-                urlpdd = API_PDD
-                payload = {'linksp': message_text}
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(urlpdd, headers=headers, data=json.dumps(payload))
-
-                if response.status_code == 200:
-                    data = response.json()
-                    logger.info(data)
-                    img_urls = data.get('topGallery', []) + data.get('viewImage', []) + data.get('detailGalleryUrl', []) + data.get('videoGallery', []) + data.get('liveVideo', [])
-                    logger.info(img_urls)
-                    cleaned_urls = [clean_image_url(url) for url in img_urls]
-                    if cleaned_urls:
-                        await download_and_send_media(update, cleaned_urls, reply_func, reply_video_func, reply_media_group_func)
-                    else:
-                        await reply_func('Không tìm thấy URL ảnh hợp lệ.')
-                else:
-                    await reply_func('Failed to fetch image details.')
+        # Một lượt quét tìm mọi link sản phẩm của mọi sàn; không có link thì xem là tra cứu mã kiện hàng
+        links = marketplaces.route(message_text)
+        handler = 'link' if links else 'tracking'
+
+        if backend.shared:
+            await enqueue_shared_job(update, handler, message_text, links)
+        elif submit_job(update, handler, message_text, links) is None:
+            await reply_func('Bạn đang có quá nhiều yêu cầu đang chờ, vui lòng thử lại sau.')
+
+# Xếp yêu cầu thành một job trong hàng đợi của process này; link mới thay thế link cũ đang xử lý của cùng chat.
+# Trả về None nếu hàng đợi của chat đã đầy.
+def submit_job(update: Update, handler: str, message_text: str, links: list):
+    reply_func = get_reply_func(update)
+    chat_id = update.effective_chat.id
+    if handler == 'tracking':
+        return job_scheduler.submit(chat_id, 'tracking', lambda: handle_tracking(update, message_text, reply_func))
+    reply_media_group_func = get_reply_media_group_func(update)
+    reply_video_func = get_reply_video_func(update)
+    return job_scheduler.submit(chat_id, 'link', lambda: handle_links(update, links, reply_func, reply_video_func, reply_media_group_func), supersede=True)
+
+# Đẩy yêu cầu vào hàng đợi dùng chung để worker bất kỳ xử lý. Update được gửi kèm dạng dict
+# để worker dựng lại và trả lời đúng tin nhắn gốc.
+async def enqueue_shared_job(update: Update, handler: str, message_text: str, links: list) -> None:
+    if handler != 'tracking':
+        # Link mới nhất của chat; worker bỏ qua các link cũ hơn chưa kịp chạy
+        await backend.set(f'latest:{update.effective_chat.id}:link', update.update_id, LATEST_LINK_TTL)
+    await backend.push(JOB_QUEUE, {'handler': handler, 'text': message_text, 'links': links, 'update': update.to_dict()})
+
+# Lấy job từ hàng đợi dùng chung và chuyển vào JobScheduler của process này.
+# Chỉ lấy thêm khi số job đang chờ cục bộ chưa vượt số worker, để các process khác cùng nhận việc.
+async def consume_shared_jobs(application) -> None:
+    while True:
+        if job_scheduler.pending_count >= job_scheduler.workers:
+            await asyncio.sleep(0.1)
+            continue
+        try:
+            item = await backend.pop(JOB_QUEUE, timeout=1)
+        except Exception as e:
+            logger.error(f"Error reading shared job queue: {e}")
+            await asyncio.sleep(1)
+            continue
+        if item is None:
+            continue
+        update = Update.de_json(item['update'], application.bot)
+        if item['handler'] != 'tracking':
+            latest = await backend.get(f'latest:{update.effective_chat.id}:link')
+            if latest is not None and latest != update.update_id:
+                logger.info(f"Skipping superseded link job for chat {update.effective_chat.id}")
+                continue
+        links = [Link(*link) for link in item.get('links', [])]
+        if submit_job(update, item['handler'], item['text'], links) is None:
+            await get_reply_func(update)('Bạn đang có quá nhiều yêu cầu đang chờ, vui lòng thử lại sau.')
+
+# Xử lý các link sản phẩm của một tin nhắn: gọi API của mọi link song song, rồi gửi media lần lượt theo thứ tự link
+async def handle_links(update: Update, links: list, reply_func, reply_video_func, reply_media_group_func) -> None:
+    tasks = [asyncio.ensure_future(fetch_link_media(link)) for link in links]
+    try:
+        for task in tasks:
+            try:
+                media_urls = await task
+            except ProductFetchError as e:
+                await reply_func(str(e))
+                continue
+            if media_urls:
+                await download_and_send_media(update, media_urls, reply_func, reply_video_func, reply_media_group_func)
             else:
-                await reply_func('Invalid Pindoudou link format.')
+                await reply_func('Không tìm thấy URL ảnh hợp lệ.')
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Danh sách URL media của một link; link rút gọn được phân giải (có ghi nhớ) thành link sản phẩm trước
+async def fetch_link_media(link: Link) -> list:
+    resolved = await resolve_link(link)
+    if resolved is None:
+        raise ProductFetchError(marketplaces.get(link.marketplace).error)
+    marketplace = marketplaces.get(resolved.marketplace)
+    link = resolved
+    product = await product_cache.get_or_fetch((marketplace.source, link.item_id), lambda: marketplace.fetch(link.item_id, link.url))
+    return marketplace.media(product)
+
+async def handle_tracking(update: Update, message_text: str, reply_func) -> None:
+    # Lọc ra các mã vận đơn có độ dài từ 10 đến 20 ký tự
+    tracking_numbers = re.findall(r'\b\w{10,20}\b', message_text)
+
+    if not tracking_numbers:
+        await reply_func('Không tìm thấy mã vận đơn hợp lệ trong tin nhắn của bạn.')
+        return
+
+    # Kiểm tra số lượng tracking_numbers
+    sheet_index = None
+    if len(tracking_numbers) == 1:
+        # Sử dụng message_text gốc để kiểm tra sheetIndex
+        if ' ' in message_text:
+            tracking_number, sheet_index = message_text.rsplit(' ', 1)
+            if not sheet_index.isdigit():
+                sheet_index = None
         else:
-            # Lọc ra các mã vận đơn có độ dài từ 10 đến 20 ký tự
-            tracking_numbers = re.findall(r'\b\w{10,20}\b', message_text)
-    
-            if not tracking_numbers:
-                await reply_func('Không tìm thấy mã vận đơn hợp lệ trong tin nhắn của bạn.')
-                return
-    
-            # Kiểm tra số lượng tracking_numbers
-            if len(tracking_numbers) == 1:
-                # Sử dụng message_text gốc để kiểm tra sheetIndex
-                if ' ' in message_text:
-                    tracking_number, sheet_index = message_text.rsplit(' ', 1)
-                    if sheet_index.isdigit():
-                        url = f'{API_URL}?sheetIndex={sheet_index}'
-                    else:
-                        url = API_URL
-                else:
-                    tracking_number = tracking_numbers[0]
-                    url = API_URL
-    
-                tracking_numbers = [tracking_number.strip()]
-            else:
-                url = API_URL
-    
-            response = requests.get(url)
-    
-            if response.status_code == 200:
-                data = response.json()
-                for tracking_number in tracking_numbers:
-                    # Lọc các phần tử trong danh sách có mã kiện hàng phù hợp
-                    tracking_infos = [item for item in data if tracking_number in str(item.get('tracking'))]
-                    if tracking_infos:
-                        for tracking_info in tracking_infos:
-                            await send_tracking_info(update, tracking_info, reply_func)
-                    else:
-                        await reply_func(f'Không tìm thấy mã kiện hàng: {tracking_number}')
-            else:
-                await reply_func('Không thể kết nối đến API. Vui lòng thử lại sau.')
+            tracking_number = tracking_numbers[0]
 
-def extract_taobao_id(url: str) -> str:
-    # Implement logic to extract Taobao ID from the URL
-    taobao_id = url.split('=')[-1]
-    return taobao_id
+        tracking_numbers = [tracking_number.strip()]
 
-def clean_image_url(url: str) -> str:
-    match = re.match(r'(https://.*?(\.jpg|\.jpeg|\.png|\.gif|\.bmp|\.webp|\.mp4))', url)
-    if match:
-        cleaned_url = match.group(1)
-        return cleaned_url
-    return url
+    try:
+        with STAGE_SECONDS.labels('tracking_lookup').time():
+            snapshot = await tracking_store.get(sheet_index)
+    except TrackingFetchError as e:
+        logging.error('Error fetching tracking sheet: %s', str(e))
+        await reply_func('Không thể kết nối đến API. Vui lòng thử lại sau.')
+        return
+
+    # Một mã: giữ định dạng chi tiết, mỗi kết quả một tin nhắn
+    if len(tracking_numbers) == 1:
+        tracking_number = tracking_numbers[0]
+        # Lọc các phần tử trong danh sách có mã kiện hàng phù hợp
+        tracking_infos = snapshot.lookup(tracking_number)
+        if tracking_infos:
+            for tracking_info in tracking_infos:
+                await send_tracking_info(update, tracking_info, reply_func)
+        else:
+            await reply_func(f'Không tìm thấy mã kiện hàng: {tracking_number}')
+        return
+
+    # Nhiều mã: tra cứu một lượt rồi gộp kết quả vào ít tin nhắn nhất có thể
+    results = snapshot.lookup_many(tracking_numbers)
+    for message in render_tracking_batch(results):
+        await reply_func(message)
+
+# /theodoi <mã> [sheetIndex]: theo dõi mã kiện hàng, bot tự báo khi trạng thái, số lượng hoặc thuộc tính thay đổi
+async def subscribe(update: Update, context: CallbackContext) -> None:
+    reply_func = get_reply_func(update)
+    if not context.args:
+        await reply_func('Cú pháp: /theodoi <mã kiện hàng> [sheetIndex]')
+        return
+    tracking_number = context.args[0]
+    sheet_index = context.args[1] if len(context.args) > 1 and context.args[1].isdigit() else None
+    try:
+        snapshot = await tracking_store.get(sheet_index)
+    except TrackingFetchError as e:
+        logging.error('Error fetching tracking sheet: %s', str(e))
+        await reply_func('Không thể kết nối đến API. Vui lòng thử lại sau.')
+        return
+    tracking_infos = snapshot.lookup(tracking_number)
+    try:
+        await tracking_history.subscribe(update.effective_chat.id, sheet_index, tracking_number, tracking_infos)
+    except SubscriptionLimitError as e:
+        await reply_func(str(e))
+        return
+    note = '' if tracking_infos else ' (hiện chưa có trong danh sách)'
+    await reply_func(f'Đã theo dõi mã kiện hàng {tracking_number}{note}. Bot sẽ báo khi trạng thái, số lượng hoặc thuộc tính thay đổi.')
+
+# /huytheodoi <mã>: ngừng theo dõi; không kèm mã thì liệt kê các mã đang theo dõi
+async def unsubscribe(update: Update, context: CallbackContext) -> None:
+    reply_func = get_reply_func(update)
+    chat_id = update.effective_chat.id
+    if not context.args:
+        subscriptions = await tracking_history.subscriptions(chat_id)
+        if not subscriptions:
+            await reply_func('Bạn chưa theo dõi mã kiện hàng nào.')
+            return
+        lines = ['Các mã đang theo dõi (gửi /huytheodoi <mã> để ngừng):']
+        lines += [tracking if sheet_index is None else f'{tracking} (sheet {sheet_index})' for sheet_index, tracking in subscriptions]
+        for message in pack_messages(lines):
+            await reply_func(message)
+        return
+    tracking_number = context.args[0]
+    if await tracking_history.unsubscribe(chat_id, tracking_number):
+        await reply_func(f'Đã ngừng theo dõi mã kiện hàng {tracking_number}.')
+    else:
+        await reply_func(f'Bạn không theo dõi mã kiện hàng {tracking_number}.')
+
+# Đồng bộ nền: mỗi chu kỳ tải lại các sheet có mã được theo dõi (một request cho mỗi sheet, 304 nếu
+# không đổi) và chỉ gửi thông báo cho các mã có rec/sl/var thay đổi so với lần trước
+async def sync_tracking_history(application) -> None:
+    while True:
+        await asyncio.sleep(TRACKING_SYNC_INTERVAL)
+        try:
+            sheet_indexes = await tracking_history.sheets()
+        except Exception as e:
+            logger.error(f"Error reading tracking subscriptions: {e}")
+            continue
+        for sheet_index in sheet_indexes:
+            try:
+                with STAGE_SECONDS.labels('tracking_sync').time():
+                    snapshot = await tracking_store.refresh(sheet_index)
+                    changes = await tracking_history.sync(sheet_index, snapshot)
+            except Exception as e:
+                logger.error(f"Error syncing tracking sheet {sheet_index}: {e}")
+                continue
+            for tracking_number, tracking_infos, chat_ids in changes:
+                message = render_tracking_update(tracking_number, tracking_infos)
+                for chat_id in chat_ids:
+                    try:
+                        await send_scheduler.send(chat_id, application.bot.send_message, chat_id, message)
+                    except Exception as e:
+                        logger.warning(f"Error notifying chat {chat_id} about {tracking_number}: {e}")
 
 def get_reply_video_func(update: Update):
     if hasattr(update, 'business_message') and update.business_message:
-        return update.business_message.reply_video
+        return send_scheduler.bind(update.effective_chat.id, update.business_message.reply_video)
     elif hasattr(update, 'message') and update.message:
-        return update.message.reply_video
+        return send_scheduler.bind(update.effective_chat.id, update.message.reply_video)
+
+# Gửi một nhóm media và ghi nhớ file_id của các tệp vừa upload
+async def send_media_group(media_group: list, reply_video_func, reply_media_group_func) -> None:
+    first = media_group[0]
+    if len(media_group) == 1 and first.is_video:
+        # Video dài (hoặc video duy nhất) gửi riêng, Telegram phát được khi đang tải
+        message = await reply_video_func(media_input(first), **video_options(first))
+        remember_sent(first, message)
+    else:
+        logger.debug('Sending media group of %d items', len(media_group))
+        messages = await reply_media_group_func([input_media(media) for media in media_group])
+        for media, message in zip(media_group, messages):
+            remember_sent(media, message)
 
 async def download_and_send_media(update: Update, media_urls: list, reply_func, reply_video_func, reply_media_group_func) -> None:
+    # Bỏ URL trùng (cùng ảnh khác kích thước CDN), giữ thứ tự; ảnh gần trùng được bỏ sau khi tải, trước khi upload
+    media_urls = dedupe_media_urls(media_urls)
     if not media_urls:
         await reply_func("Không có URL hợp lệ để tải xuống.")
         logging.warning('No valid URLs provided to download_and_send_media.')
         return
 
     await reply_func("Đang tải ảnh lên...")
-    logging.info('Downloading and sending media, URLs: %s', media_urls)
+    if log_sampled(logger):
+        logger.debug('Downloading and sending media, URLs: %s', media_urls)
 
-    temp_dir = tempfile.mkdtemp()
-    logging.info('Created temporary directory: %s', temp_dir)
+    temp_dir = media_cache.make_temp_dir()
+    logger.debug('Created temporary directory: %s', temp_dir)
+    started = time.monotonic()
     try:
-        downloaded_images = []
-        downloaded_videos = []
-        
-        for media_url in media_urls:
-            try:
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                }
-                success = False
-                attempts = 0
-                while not success and attempts < 3:  # Thử tối đa 3 lần
-                    response = requests.get(media_url, headers=headers, stream=True)
-                    logging.info('Media URL %s response status: %d', media_url, response.status_code)
-                    if response.status_code == 200:
-                        # Parse để lấy phần path của URL
-                        parsed_url = urlparse(media_url)
-                        path = parsed_url.path
-                        # Xóa các tham số query sau dấu "?"
-                        base_filename = os.path.basename(path).split('?')[0]
-                        # Lấy phần mở rộng của file từ URL
-                        file_extension = os.path.splitext(base_filename)[1]
-
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-                            shutil.copyfileobj(response.raw, tmp_file)
-                            tmp_file_path = tmp_file.name
-                        logging.info('Downloaded file to %s', tmp_file_path)
-
-                        if tmp_file_path.endswith('.mp4'):
-                            downloaded_videos.append(tmp_file_path)
-                        else:
-                            try:
-                                with Image.open(tmp_file_path) as img:
-                                    if img.size[0] < 200 or img.size[1] < 200:
-                                        logging.info('Image %s is too small, skipping.', tmp_file_path)
-                                        os.remove(tmp_file_path)
-                                    else:
-                                        downloaded_images.append(tmp_file_path)
-                            except Exception as e:
-                                logging.error('Error checking image size for %s: %s', tmp_file_path, str(e))
-                                os.remove(tmp_file_path)
-                        success = True
-                    elif response.status_code == 420:
-                        time.sleep(1)  # Chờ 1 giây trước khi thử lại
+        # Gửi từng nhóm ngay khi sẵn sàng trong lúc các tệp sau vẫn đang được tải
+        sent_count = 0
+        media_groups = stream_media_groups(media_urls, temp_dir)
+        try:
+            async for media_group in media_groups:
+                try:
+                    first = media_group[0]
+                    if first.is_link:
+                        # Quá giới hạn upload của Telegram: gửi liên kết để người dùng tự mở
+                        await reply_func(f"Video quá lớn để gửi qua Telegram ({first.size / 1024 ** 2:.0f} MB), xem tại: {first.url}")
                     else:
-                        break
-                    attempts += 1
+                        try:
+                            await send_media_group(media_group, reply_video_func, reply_media_group_func)
+                        except BadRequest as e:
+                            if all(media.file_id is None for media in media_group):
+                                raise
+                            # file_id đã lưu không còn dùng được: bỏ khỏi cache và gửi lại bằng upload mới
+                            logger.warning('Telegram rejected cached file_ids (%s), uploading again', e)
+                            media_group[:] = await refetch_without_file_ids(media_group, temp_dir)
+                            if media_group:
+                                await send_media_group(media_group, reply_video_func, reply_media_group_func)
+                finally:
+                    # Giải phóng bộ đệm và tệp tạm ngay sau khi gửi
+                    for media in media_group:
+                        media.close()
+                sent_count += len(media_group)
+        finally:
+            await media_groups.aclose()
 
-            except Exception as e:
-                logging.error('Exception occurred while downloading media: %s, error: %s', media_url, str(e))
-
-        if not downloaded_images and not downloaded_videos:
+        if not sent_count:
             await reply_func("Không tải xuống được tệp nào.")
             logging.warning('No files were downloaded.')
             return
 
-        # Gửi các video riêng lẻ
-        if downloaded_videos:
-            for video_path in downloaded_videos:
-                await reply_video_func([InputMediaVideo(open(video_path, 'rb'))])
-                time.sleep(3)  # Nghỉ 3 giây giữa mỗi lần gửi video
-        
-        # Nhóm các hình ảnh và gửi chúng
-        if downloaded_images:
-            media_groups = []
-            for i in range(0, len(downloaded_images), 9):
-                media_group = downloaded_images[i:i + 9]
-                media_objects = [InputMediaPhoto(open(file_path, 'rb')) for file_path in media_group]
-                media_groups.append(media_objects)
-
-            logging.info('Sending media groups')
-            for media_group in media_groups:
-                await reply_media_group_func(media_group)  # Tăng thời gian chờ lên 60 giây
-                time.sleep(3)  # Nghỉ 3 giây giữa mỗi lần gửi media group
-
+        stats = image_transcoder.stats
+        logger.debug('Image transcode: %d/%d images re-encoded, %d bytes saved so far', stats.transcoded, stats.images, stats.bytes_saved)
         await reply_func("Gửi tin nhắn hoàn tất.")
     except Exception as e:
         await reply_func("Đã xảy ra lỗi trong quá trình gửi tin nhắn.")
         logging.error('Error during media download or send: %s', str(e))
     finally:
+        STAGE_SECONDS.labels('media').observe(time.monotonic() - started)
         shutil.rmtree(temp_dir)
-        logging.info('Removed temporary directory: %s', temp_dir)
+        logger.debug('Removed temporary directory: %s', temp_dir)
 
-async def send_tracking_info(update: Update, tracking_info: dict, reply_func) -> None:
+def tracking_fields(tracking_info: dict) -> tuple:
     tracking = tracking_info.get('tracking', 'Không có mã')
     imgurl = tracking_info.get('imgurl', 'Không có ảnh')
     imgurl = re.sub(r'_(\d+x\d+\.jpg)$', '', imgurl)
@@ -279,19 +388,193 @@ async def send_tracking_info(update: Update, tracking_info: dict, reply_func) ->
     var = tracking_info.get('var', 'Không có thuộc tính')
     sl = tracking_info.get('sl', 'Không có số lượng')
     status = "Đã nhận hàng" if rec else "Chưa nhận hàng"
-    message = f"Mã kiện hàng: {tracking}\nTrạng thái đơn hàng: {status}\nSố lượng: {sl}\nThuộc Tính: {var}\nHình ảnh: {imgurl}"
-    await reply_func(message)
-    await asyncio.sleep(1)  # Thêm thời gian nghỉ để tránh spam
+    return tracking, status, sl, var, imgurl
+
+def format_tracking_info(tracking_info: dict) -> str:
+    tracking, status, sl, var, imgurl = tracking_fields(tracking_info)
+    return f"Mã kiện hàng: {tracking}\nTrạng thái đơn hàng: {status}\nSố lượng: {sl}\nThuộc Tính: {var}\nHình ảnh: {imgurl}"
+
+async def send_tracking_info(update: Update, tracking_info: dict, reply_func) -> None:
+    await reply_func(format_tracking_info(tracking_info))
+
+# Thông báo thay đổi của một mã đang theo dõi; mã đã nhận hàng ở mọi dòng được tự động ngừng theo dõi
+def render_tracking_update(tracking_number: str, tracking_infos: list) -> str:
+    if not tracking_infos:
+        return f'Mã kiện hàng {tracking_number} không còn trong danh sách.'
+    message = '\n\n'.join(['Cập nhật kiện hàng đang theo dõi:'] + [format_tracking_info(tracking_info) for tracking_info in tracking_infos])
+    if all(tracking_info.get('rec', False) for tracking_info in tracking_infos):
+        message += '\n\nĐã nhận hàng, ngừng theo dõi mã này.'
+    return message[:MAX_MESSAGE_LENGTH]
+
+# Hiển thị kết quả tra cứu nhiều mã dạng bảng gọn, các mã không tìm thấy được gom chung một dòng
+def render_tracking_batch(results: dict) -> list:
+    lines = ['Mã kiện hàng | Trạng thái | SL | Thuộc tính | Hình ảnh']
+    not_found = []
+    for tracking_number, tracking_infos in results.items():
+        if not tracking_infos:
+            not_found.append(tracking_number)
+        for tracking_info in tracking_infos:
+            lines.append(' | '.join(str(field) for field in tracking_fields(tracking_info)))
+    if len(lines) == 1:
+        lines = []
+    if not_found:
+        lines.append(f"Không tìm thấy mã kiện hàng: {', '.join(not_found)}")
+    return pack_messages(lines)
+
+# Ghép các dòng thành ít tin nhắn nhất, mỗi tin không vượt quá giới hạn ký tự của Telegram
+def pack_messages(lines: list, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    messages = []
+    current = ''
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+# Warm-up trước khi nhận update: nạp lại chỉ mục cache media và ảnh chụp các cache trong bộ nhớ,
+# rồi tải trước (hoặc xác nhận bằng 304) các sheet mã kiện hàng. Phần chưa xong khi hết thời gian
+# tiếp tục chạy nền; bot vẫn sẵn sàng với dữ liệu đã nạp từ ảnh chụp.
+async def warm_up(timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    await asyncio.gather(asyncio.to_thread(media_cache.load), asyncio.to_thread(cache_snapshot.load))
+    if not API_URL:
+        return
+    sheet_indexes = {None}
+    if BOT_ROLE != 'worker':
+        sheet_indexes.update(await tracking_history.sheets())
+    refreshes = [asyncio.ensure_future(tracking_store.refresh(sheet_index)) for sheet_index in sheet_indexes]
+    done, pending = await asyncio.wait(refreshes, timeout=max(0.0, deadline - time.monotonic()))
+    for task in refreshes:
+        # Lỗi tải sheet đã được TrackingStore ghi log
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    if pending:
+        logger.warning('Tracking sheet warm-up did not finish within the startup budget, continuing in the background')
+
+# Ghi ảnh chụp cache định kỳ, để process bị dừng đột ngột vẫn khởi động lại với cache còn mới
+async def save_cache_snapshots() -> None:
+    while True:
+        await asyncio.sleep(CACHE_SNAPSHOT_INTERVAL)
+        try:
+            await cache_snapshot.save()
+        except Exception as e:
+            logger.warning(f"Error saving cache snapshot: {e}")
+
+# Khởi tạo và đóng client HTTP, cache media, hàng đợi job và process pool nén ảnh theo vòng đời của ứng dụng.
+# post_init chạy xong (gồm warm-up) thì bot mới bắt đầu polling, nhận webhook hoặc lấy job dùng chung.
+async def post_init(application) -> None:
+    init_done = time.monotonic()
+    JOBS_PENDING.set_function(lambda: job_scheduler.pending_count)
+    JOBS_RUNNING.set_function(lambda: job_scheduler.running_count)
+    if BOT_MODE != 'webhook' or BOT_ROLE == 'worker':
+        # Chế độ webhook phục vụ /metrics trên chính web server của nó
+        start_metrics_server()
+    await http_client.start()
+    if BOT_ROLE != 'worker':
+        # Lệnh theo dõi do process nhận update xử lý, nên process đó giữ cơ sở dữ liệu và chạy đồng bộ
+        tracking_history.open()
+    await warm_up(STARTUP_BUDGET - (init_done - PROCESS_STARTED_AT))
+    warm_up_done = time.monotonic()
+
+    await job_scheduler.start()
+    if backend.shared and BOT_ROLE != 'ingress':
+        application.bot_data['job_consumer'] = asyncio.ensure_future(consume_shared_jobs(application))
+    if BOT_ROLE != 'worker' and TRACKING_SYNC_INTERVAL > 0:
+        application.bot_data['tracking_sync'] = asyncio.ensure_future(sync_tracking_history(application))
+    if CACHE_SNAPSHOT_INTERVAL > 0:
+        application.bot_data['cache_snapshot'] = asyncio.ensure_future(save_cache_snapshots())
+
+    ready = time.monotonic() - PROCESS_STARTED_AT
+    STARTUP_SECONDS.labels('init').set(init_done - PROCESS_STARTED_AT)
+    STARTUP_SECONDS.labels('warm_up').set(warm_up_done - init_done)
+    STARTUP_SECONDS.labels('ready').set(ready)
+    READY.set(1)
+    if ready > STARTUP_BUDGET:
+        logger.warning('Ready after %.2fs, over the %.0fs startup budget (init %.2fs, warm-up %.2fs)', ready, STARTUP_BUDGET, init_done - PROCESS_STARTED_AT, warm_up_done - init_done)
+    else:
+        logger.info('Ready after %.2fs (init %.2fs, warm-up %.2fs)', ready, init_done - PROCESS_STARTED_AT, warm_up_done - init_done)
+
+# Dừng các tác vụ nền: lấy job dùng chung, đồng bộ mã theo dõi, ghi ảnh chụp cache
+async def stop_background_tasks(application) -> None:
+    for name in ('job_consumer', 'tracking_sync', 'cache_snapshot'):
+        task = application.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+# Chạy sau khi ngừng nhận update nhưng trước Application.shutdown(), khi bot vẫn gửi tin được:
+# ngừng nhận job mới từ hàng đợi dùng chung (phần còn lại để các worker khác xử lý) và chờ các job đang xử lý gửi xong
+async def post_stop(application) -> None:
+    READY.set(0)
+    await stop_background_tasks(application)
+    await job_scheduler.drain()
+    await job_scheduler.stop()
+
+# Chạy sau Application.shutdown() (client HTTP của bot đã đóng): chỉ đóng các tài nguyên dùng chung.
+# Tác vụ nền và job còn lại (nếu post_stop không được gọi, ví dụ lỗi khi khởi động) bị hủy luôn.
+async def post_shutdown(application) -> None:
+    READY.set(0)
+    await stop_background_tasks(application)
+    await job_scheduler.stop()
+    await http_client.close()
+    await media_cache.save()
+    try:
+        await cache_snapshot.save()
+    except Exception as e:
+        logger.warning(f"Error saving cache snapshot: {e}")
+    tracking_history.close()
+    image_transcoder.close()
+    await backend.close()
+
+# Trạng thái hàng đợi job hiển thị ở endpoint health
+def job_status() -> dict:
+    return {'jobs_pending': job_scheduler.pending_count, 'jobs_running': job_scheduler.running_count}
 
 def main() -> None:
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).read_timeout(30).write_timeout(30).build()
+    if BOT_ROLE != 'all' and not backend.shared:
+        raise RuntimeError(f'BOT_ROLE={BOT_ROLE} requires REDIS_URL to share the job queue')
+    # Server Bot API tự host (BOT_API_URL) nếu trả lời được, ngược lại là api.telegram.org
+    bot_api.check(TELEGRAM_TOKEN)
+    builder = bot_api.configure(
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .read_timeout(30)
+        .write_timeout(30)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook' or BOT_ROLE == 'worker':
+        # Update được đưa vào từ web server riêng hoặc từ hàng đợi dùng chung, không cần Updater
+        application = builder.updater(None).build()
+    else:
+        application = builder.build()
 
     # Thêm các handler
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("theodoi", subscribe))
+    application.add_handler(CommandHandler("huytheodoi", unsubscribe))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Chạy bot
-    application.run_polling()
+    # webhook.py (aiohttp) và worker.py chỉ được import trong chế độ dùng đến, không làm chậm khởi động ở chế độ khác
+    if BOT_ROLE == 'worker':
+        from worker import run_worker
+        asyncio.run(run_worker(application))
+    elif BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        asyncio.run(run_webhook(application, status=job_status))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
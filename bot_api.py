@@ -0,0 +1,66 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Telegram Bot API server tự host (https://github.com/tdlib/telegram-bot-api), ví dụ http://telegram-bot-api:8081;
+# bỏ trống để dùng api.telegram.org
+BOT_API_URL = os.getenv('BOT_API_URL', '').rstrip('/')
+# Server chạy với cờ --local: gửi media bằng đường dẫn file:// thay vì upload nội dung, giới hạn tệp 2000 MB.
+# Server phải đọc được thư mục cache media ở cùng đường dẫn (dùng chung volume).
+BOT_API_LOCAL_MODE = os.getenv('BOT_API_LOCAL_MODE', '1') == '1'
+# Thời gian chờ kiểm tra server tự host lúc khởi động
+BOT_API_CHECK_TIMEOUT = float(os.getenv('BOT_API_CHECK_TIMEOUT', '5'))
+
+# Giới hạn upload của api.telegram.org và của server tự host ở chế độ --local
+PUBLIC_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+LOCAL_MAX_UPLOAD_BYTES = 2000 * 1024 * 1024
+
+
+# Server Bot API bot đang dùng. Lưu ý: chuyển bot giữa api.telegram.org và server tự host cần gọi logOut
+# trên api.telegram.org một lần trước đó; việc quay về chỉ xảy ra khi server tự host không trả lời lúc khởi động.
+class BotApiServer:
+    def __init__(self, url: str = BOT_API_URL, local_mode: bool = BOT_API_LOCAL_MODE):
+        self.url = url or None
+        self.local_mode = bool(url) and local_mode
+
+    @property
+    def max_upload_bytes(self) -> int:
+        return LOCAL_MAX_UPLOAD_BYTES if self.local_mode else PUBLIC_MAX_UPLOAD_BYTES
+
+    # Gọi getMe trên server tự host; nếu không trả lời được thì quay về api.telegram.org.
+    # Chạy trước khi dựng Application nên dùng request đồng bộ.
+    def check(self, token: str) -> None:
+        if self.url is None:
+            return
+        try:
+            response = httpx.post(f'{self.url}/bot{token}/getMe', timeout=BOT_API_CHECK_TIMEOUT)
+            ok = response.status_code == 200 and response.json().get('ok') is True
+            error = f'HTTP {response.status_code}'
+        except (httpx.HTTPError, ValueError) as e:
+            ok, error = False, str(e)
+        if not ok:
+            logger.warning('Bot API server %s is unavailable (%s), falling back to api.telegram.org', self.url, error)
+            self.url = None
+            self.local_mode = False
+            return
+        logger.info('Using Bot API server %s%s', self.url, ' in local mode' if self.local_mode else '')
+
+    # Trỏ ApplicationBuilder tới server tự host (nếu có)
+    def configure(self, builder):
+        if self.url is None:
+            return builder
+        return builder.base_url(f'{self.url}/bot').base_file_url(f'{self.url}/file/bot').local_mode(self.local_mode)
+
+    # Đường dẫn tệp để server đọc trực tiếp (PTB gửi dạng file://), None nếu phải upload nội dung
+    def file_input(self, path: Optional[str]) -> Optional[Path]:
+        if not self.local_mode or path is None:
+            return None
+        return Path(os.path.abspath(path))
+
+
+bot_api = BotApiServer()
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tệp ảnh chụp các cache trong bộ nhớ (sheet mã kiện hàng, dữ liệu sản phẩm, link rút gọn đã phân giải),
+# được nạp lại khi khởi động để yêu cầu đầu tiên sau khi restart không phải chờ cache nguội
+CACHE_SNAPSHOT = os.getenv('CACHE_SNAPSHOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'snapshot.json'))
+# Chu kỳ (giây) ghi ảnh chụp trong lúc chạy, để vẫn còn dữ liệu mới khi process bị dừng đột ngột; 0 để tắt
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv('CACHE_SNAPSHOT_INTERVAL', '600'))
+
+
+# Ảnh chụp nhiều cache trong một tệp JSON. Mỗi cache đăng ký một cặp hàm dump() -> dữ liệu JSON được
+# và load(dữ liệu, số giây đã trôi qua kể từ lúc chụp).
+class CacheSnapshot:
+    def __init__(self, path: str = CACHE_SNAPSHOT):
+        self.path = path
+        self._sources: Dict[str, Tuple[Callable[[], Any], Callable[[Any, float], None]]] = {}
+
+    def register(self, name: str, dump: Callable[[], Any], load: Callable[[Any, float], None]) -> None:
+        self._sources[name] = (dump, load)
+
+    # Nạp lại các cache từ tệp; chạy trước khi bot nhận update nên được phép chạy trong thread riêng
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read cache snapshot %s: %s', self.path, e)
+            return
+        elapsed = max(0.0, time.time() - snapshot.get('saved_at', 0))
+        for name, data in snapshot.get('caches', {}).items():
+            source = self._sources.get(name)
+            if source is None:
+                continue
+            try:
+                source[1](data, elapsed)
+            except Exception as e:
+                logger.warning('Could not restore %s cache from snapshot: %s', name, e)
+        logger.info('Loaded cache snapshot %s taken %.0f s ago', self.path, elapsed)
+
+    # Lấy dữ liệu trên event loop (tránh đọc cache đang bị sửa), mã hóa và ghi tệp trong thread riêng
+    async def save(self) -> None:
+        snapshot = {'saved_at': time.time(), 'caches': {name: dump() for name, (dump, _) in self._sources.items()}}
+        await asyncio.to_thread(self._write, snapshot)
+
+    def _write(self, snapshot: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+cache_snapshot = CacheSnapshot()
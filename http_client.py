@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import random
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from metrics import HTTP_RETRY_EVENTS, HTTP_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình kết nối dùng chung cho mọi lời gọi ra ngoài
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', '10'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', '0.5'))
+
+# Các mã trạng thái nên thử lại (420 là mã giới hạn tốc độ của CDN Taobao)
+RETRY_STATUSES = frozenset({420, 429, 500, 502, 503, 504})
+
+
+# Client HTTP bất đồng bộ dùng chung: giữ kết nối, giới hạn theo host, thử lại có backoff
+class HttpClient:
+    def __init__(self, max_per_host: int = HTTP_MAX_PER_HOST, retries: int = HTTP_RETRIES, backoff: float = HTTP_BACKOFF):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            follow_redirects=True,
+        )
+        logger.info('HTTP client started')
+
+    async def close(self) -> None:
+        if self._client is None:
+            return
+        await self._client.aclose()
+        self._client = None
+        self._host_limits.clear()
+        logger.info('HTTP client closed')
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError('HTTP client is not started')
+        return self._client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = self._host_limits[host] = asyncio.Semaphore(self.max_per_host)
+        return limit
+
+    # Backoff lũy thừa có jitter để các lượt thử lại không dồn vào cùng một thời điểm
+    def _delay(self, attempt: int) -> float:
+        delay = self.backoff * (2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def request(self, method: str, url: str, retry_statuses=RETRY_STATUSES, **kwargs) -> httpx.Response:
+        async with self._stream(method, url, retry_statuses, **kwargs) as response:
+            await response.aread()
+        return response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    # Mở response dạng stream; chỉ thử lại trước khi đọc body
+    def stream(self, method: str, url: str, retry_statuses=RETRY_STATUSES, **kwargs):
+        return self._stream(method, url, retry_statuses, **kwargs)
+
+    @asynccontextmanager
+    async def _stream(self, method: str, url: str, retry_statuses, **kwargs) -> AsyncIterator[httpx.Response]:
+        host = urlparse(url).netloc
+        # follow_redirects là tham số của send(), không phải của build_request()
+        follow_redirects = kwargs.pop('follow_redirects', self.client.follow_redirects)
+        async with self._host_limit(url):
+            attempt = 0
+            while True:
+                try:
+                    response = await self.client.send(self.client.build_request(method, url, **kwargs), stream=True, follow_redirects=follow_redirects)
+                except httpx.TransportError as e:
+                    if attempt >= self.retries:
+                        raise
+                    HTTP_RETRY_EVENTS.labels(host, type(e).__name__).inc()
+                    logger.warning('%s %s failed (%s), retrying', method, url, e)
+                else:
+                    if response.status_code in (420, 429):
+                        HTTP_THROTTLED.labels(host, str(response.status_code)).inc()
+                    if response.status_code not in retry_statuses or attempt >= self.retries:
+                        break
+                    await response.aclose()
+                    HTTP_RETRY_EVENTS.labels(host, str(response.status_code)).inc()
+                    logger.warning('%s %s returned %d, retrying', method, url, response.status_code)
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+
+            try:
+                yield response
+            finally:
+                await response.aclose()
+
+
+# Client dùng chung cho toàn bộ ứng dụng, khởi tạo khi bot khởi động và đóng khi tắt
+http_client = HttpClient()
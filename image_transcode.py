@@ -0,0 +1,163 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from metrics import IMAGE_TRANSCODE_BYTES, IMAGE_TRANSCODE_IMAGES
+
+logger = logging.getLogger(__name__)
+
+# Bật/tắt bước nén lại ảnh trước khi upload
+IMAGE_TRANSCODE = os.getenv('IMAGE_TRANSCODE', '1') == '1'
+# Cạnh dài tối đa sau khi thu nhỏ (Telegram hiển thị ảnh tối đa 2560px)
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '2560'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+# Ảnh JPEG nhỏ hơn ngưỡng này và không cần thu nhỏ thì gửi nguyên bản
+IMAGE_TRANSCODE_MIN_BYTES = int(os.getenv('IMAGE_TRANSCODE_MIN_BYTES', str(300 * 1024)))
+IMAGE_TRANSCODE_WORKERS = int(os.getenv('IMAGE_TRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+
+
+# Thu nhỏ, chuyển sang JPEG và bỏ metadata. Chạy trong process con.
+# Trả về None nếu nên giữ nguyên ảnh gốc (ảnh động, đã đủ nhỏ, hoặc kết quả không nhỏ hơn).
+def transcode_image(data: bytes, max_side: int, quality: int, min_bytes: int, min_side: int) -> Optional[bytes]:
+    # Pillow chỉ được import trong process con khi có ảnh cần xử lý, không làm chậm lúc khởi động bot
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        if getattr(img, 'is_animated', False):
+            return None
+        width, height = img.size
+        scale = min(1.0, max_side / max(width, height))
+        # Không thu nhỏ tới mức cạnh ngắn dưới ngưỡng bị lọc
+        scale = max(scale, min(1.0, min_side / min(width, height)))
+        if scale == 1.0 and img.format == 'JPEG' and len(data) <= min_bytes:
+            return None
+
+        # Xoay theo EXIF trước khi bỏ metadata để ảnh hiển thị đúng chiều
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=quality, optimize=True)
+    result = out.getvalue()
+    return result if len(result) < len(data) else None
+
+
+# Kích thước lưới màu trong hash cảm nhận
+PHASH_GRID = 4
+
+
+# Hash cảm nhận của ảnh, gồm hai phần gói trong một số nguyên:
+# - dHash 64 bit: so sánh độ sáng các điểm ảnh kề nhau trên ảnh xám thu nhỏ 9x8; ảnh giống nhau ở kích thước
+#   hoặc mức nén khác nhau cho hash gần như trùng
+# - màu trung bình của lưới 4x4 (48 byte): phân biệt các biến thể màu của cùng một mẫu (ảnh SKU), vốn có
+#   dHash gần giống nhau
+# Chạy trong process con.
+def image_phash(data: bytes) -> int:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG được giải mã thẳng ở tỉ lệ nhỏ, nhanh hơn nhiều so với giải mã đầy đủ rồi thu nhỏ
+        img.draft('RGB', (128, 128))
+        img = img.convert('RGB')
+        gray = img.convert('L').resize((9, 8), Image.BOX).tobytes()
+        colors = img.resize((PHASH_GRID, PHASH_GRID), Image.BOX).tobytes()
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            dhash = (dhash << 1) | (gray[row * 9 + col] > gray[row * 9 + col + 1])
+    return (int.from_bytes(colors, 'big') << 64) | dhash
+
+
+# Hai ảnh gần trùng nếu dHash lệch không quá max_distance bit và màu từng ô lệch không quá max_color_diff
+def is_near_duplicate(a: int, b: int, max_distance: int, max_color_diff: int) -> bool:
+    mask = (1 << 64) - 1
+    if bin((a ^ b) & mask).count('1') > max_distance:
+        return False
+    size = PHASH_GRID * PHASH_GRID * 3
+    colors_a = (a >> 64).to_bytes(size, 'big')
+    colors_b = (b >> 64).to_bytes(size, 'big')
+    return all(abs(x - y) <= max_color_diff for x, y in zip(colors_a, colors_b))
+
+
+# Thống kê dung lượng tiết kiệm được nhờ nén lại, đồng thời xuất ra /metrics
+class TranscodeStats:
+    def __init__(self):
+        self.images = 0
+        self.transcoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, bytes_in: int, bytes_out: int) -> None:
+        self.images += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        IMAGE_TRANSCODE_BYTES.labels('in').inc(bytes_in)
+        IMAGE_TRANSCODE_BYTES.labels('out').inc(bytes_out)
+        if bytes_out < bytes_in:
+            self.transcoded += 1
+            IMAGE_TRANSCODE_IMAGES.labels('reencoded').inc()
+        else:
+            IMAGE_TRANSCODE_IMAGES.labels('kept').inc()
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+
+# Bước nén lại ảnh chạy trong process pool để không chặn event loop
+class ImageTranscoder:
+    def __init__(self, enabled: bool = IMAGE_TRANSCODE, workers: int = IMAGE_TRANSCODE_WORKERS):
+        self.enabled = enabled
+        self.workers = workers
+        self.stats = TranscodeStats()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # Trả về nội dung JPEG đã nén lại, hoặc None nếu nên giữ nguyên ảnh gốc
+    async def transcode(self, data: bytes, min_side: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self._executor(), transcode_image, data, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_TRANSCODE_MIN_BYTES, min_side
+            )
+        except Exception as e:
+            logger.warning('Image transcode failed, sending original: %s', e)
+            result = None
+        self.stats.record(len(data), len(result) if result is not None else len(data))
+        if result is not None:
+            logger.debug('Transcoded image %d -> %d bytes', len(data), len(result))
+        return result
+
+    # Hash cảm nhận của ảnh, tính trong cùng process pool; None nếu không đọc được ảnh
+    async def phash(self, data: bytes) -> Optional[int]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), image_phash, data)
+        except Exception as e:
+            logger.warning('Image hash failed: %s', e)
+            return None
+
+
+image_transcoder = ImageTranscoder()
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Số worker xử lý job đồng thời trên toàn bot
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+# Số job của một chat được chạy cùng lúc
+JOB_MAX_PER_CHAT = int(os.getenv('JOB_MAX_PER_CHAT', '1'))
+# Số job tối đa của một chat được xếp hàng chờ
+JOB_MAX_QUEUED_PER_CHAT = int(os.getenv('JOB_MAX_QUEUED_PER_CHAT', '10'))
+# Thời gian tối đa chờ các job còn lại hoàn tất khi tắt bot
+JOB_DRAIN_TIMEOUT = float(os.getenv('JOB_DRAIN_TIMEOUT', '60'))
+
+
+# Một yêu cầu của người dùng (một link sản phẩm hoặc một lượt tra cứu mã kiện hàng)
+class Job:
+    __slots__ = ('chat_id', 'kind', 'run', 'task', 'cancelled', 'submitted_at')
+
+    def __init__(self, chat_id: Hashable, kind: str, run: Callable[[], Awaitable]):
+        self.chat_id = chat_id
+        self.kind = kind
+        self.run = run
+        self.submitted_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+# Hàng đợi job với pool worker cố định: luân phiên giữa các chat (round-robin),
+# giới hạn số job chạy cùng lúc của mỗi chat và hủy job cũ khi có job mới thay thế
+class JobScheduler:
+    def __init__(self, workers: int = JOB_WORKERS, max_per_chat: int = JOB_MAX_PER_CHAT, max_queued_per_chat: int = JOB_MAX_QUEUED_PER_CHAT):
+        self.workers = workers
+        self.max_per_chat = max_per_chat
+        self.max_queued_per_chat = max_queued_per_chat
+        self._pending: Dict[Hashable, Deque[Job]] = {}
+        self._running: Dict[Hashable, List[Job]] = {}
+        # Các chat đang có job chờ và còn suất chạy, theo thứ tự luân phiên
+        self._ready: Optional[asyncio.Queue] = None
+        self._ready_set: Set[Hashable] = set()
+        self._workers: List[asyncio.Task] = []
+        self._stopping = False
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._stopping = False
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        logger.info('Job scheduler started with %d workers', self.workers)
+
+    # Chờ mọi job đang chờ và đang chạy hoàn tất; trả về False nếu hết thời gian
+    async def drain(self, timeout: float = JOB_DRAIN_TIMEOUT) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending_count or self.running_count:
+            if loop.time() >= deadline:
+                logger.warning('Job drain timed out with %d pending and %d running jobs', self.pending_count, self.running_count)
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def stop(self) -> None:
+        # Đánh dấu trước khi hủy: job đang chạy cũng bị hủy nên worker không phân biệt được qua job.cancelled
+        self._stopping = True
+        for chat_jobs in list(self._pending.values()) + list(self._running.values()):
+            for job in list(chat_jobs):
+                job.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._pending.clear()
+        self._running.clear()
+        self._ready_set.clear()
+        logger.info('Job scheduler stopped')
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def running_count(self) -> int:
+        return sum(len(jobs) for jobs in self._running.values())
+
+    # Xếp job vào hàng đợi của chat. supersede=True hủy các job cùng loại đang chờ hoặc đang chạy
+    # của chat đó (ví dụ người dùng gửi link mới). Trả về None nếu hàng đợi của chat đã đầy.
+    def submit(self, chat_id: Hashable, kind: str, run: Callable[[], Awaitable], supersede: bool = False) -> Optional[Job]:
+        if supersede:
+            self.cancel(chat_id, kind)
+        pending = self._pending.setdefault(chat_id, deque())
+        if len(pending) >= self.max_queued_per_chat:
+            return None
+        job = Job(chat_id, kind, run)
+        pending.append(job)
+        self._mark_ready(chat_id)
+        return job
+
+    def cancel(self, chat_id: Hashable, kind: Optional[str] = None) -> int:
+        cancelled = 0
+        pending = self._pending.get(chat_id)
+        if pending:
+            for job in [job for job in pending if kind is None or job.kind == kind]:
+                pending.remove(job)
+                job.cancel()
+                cancelled += 1
+        for job in self._running.get(chat_id, []):
+            if kind is None or job.kind == kind:
+                job.cancel()
+                cancelled += 1
+        if cancelled:
+            logger.info('Cancelled %d %s job(s) for chat %s', cancelled, kind or 'queued', chat_id)
+        return cancelled
+
+    def _mark_ready(self, chat_id: Hashable) -> None:
+        if chat_id in self._ready_set or not self._pending.get(chat_id):
+            return
+        if len(self._running.get(chat_id, [])) >= self.max_per_chat:
+            return
+        self._ready_set.add(chat_id)
+        self._ready.put_nowait(chat_id)
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            self._ready_set.discard(chat_id)
+            pending = self._pending.get(chat_id)
+            if not pending:
+                self._pending.pop(chat_id, None)
+                continue
+            job = pending.popleft()
+            running = self._running.setdefault(chat_id, [])
+            running.append(job)
+            # Chat vẫn còn job chờ thì xếp lại cuối hàng để chia đều cho các chat khác
+            self._mark_ready(chat_id)
+            started = time.monotonic()
+            STAGE_SECONDS.labels('job_queue_wait').observe(started - job.submitted_at)
+            try:
+                job.task = asyncio.ensure_future(job.run())
+                await job.task
+            except asyncio.CancelledError:
+                if self._stopping or not job.cancelled:
+                    # Chính worker bị hủy (bot đang tắt)
+                    job.task.cancel()
+                    raise
+                logger.info('Job %s for chat %s was cancelled', job.kind, chat_id)
+            except Exception:
+                logger.exception('Job %s for chat %s failed', job.kind, chat_id)
+            finally:
+                STAGE_SECONDS.labels(f'job_{job.kind}').observe(time.monotonic() - started)
+                running.remove(job)
+                if not running:
+                    self._running.pop(chat_id, None)
+                if not pending:
+                    self._pending.pop(chat_id, None)
+                self._mark_ready(chat_id)
+
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urljoin, urlparse
+
+import httpx
+
+from backends import backend
+from http_client import http_client
+from metrics import STAGE_SECONDS, UPSTREAM_SECONDS, log_sampled
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+API_TB = os.getenv('API_TB')
+API2_TB = os.getenv('API2_TB')
+API_PDD = os.getenv('API_PDD')
+# API lấy dữ liệu sản phẩm 1688, trả về cùng dạng với API_TB; bỏ trống thì link 1688 được báo là chưa hỗ trợ
+API_1688 = os.getenv('API_1688')
+# Phân giải link rút gọn: tổng thời gian tối đa, số lần chuyển hướng và số byte trang HTML được đọc
+SHORTLINK_TIMEOUT = float(os.getenv('SHORTLINK_TIMEOUT', '3'))
+SHORTLINK_MAX_HOPS = 5
+SHORTLINK_MAX_BYTES = 64 * 1024
+# Link rút gọn -> link sản phẩm đã phân giải
+SHORTLINK_CACHE_TTL = float(os.getenv('SHORTLINK_CACHE_TTL', str(7 * 24 * 3600)))
+SHORTLINK_CACHE_SIZE = int(os.getenv('SHORTLINK_CACHE_SIZE', '10000'))
+
+
+class ProductFetchError(Exception):
+    pass
+
+
+# Một link sản phẩm tìm thấy trong tin nhắn: tên sàn, URL và mã sản phẩm (None nếu cần phân giải, ví dụ link rút gọn)
+class Link(NamedTuple):
+    marketplace: str
+    url: str
+    item_id: Optional[str]
+
+
+# Một sàn thương mại điện tử: mẫu URL, cách đọc mã sản phẩm, hàm gọi API và cách lấy danh sách media từ dữ liệu trả về.
+# source là khóa cache dùng chung cho các sàn cùng nguồn dữ liệu (Taobao và Tmall);
+# error là câu trả lời khi link không đọc được mã sản phẩm.
+class Marketplace:
+    def __init__(self, name: str, label: str, pattern: str, parse_id: Callable[[str], Optional[str]],
+                 fetch: Optional[Callable[[str, str], Awaitable[Any]]] = None,
+                 media: Optional[Callable[[Any], List[str]]] = None,
+                 resolve: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+                 source: Optional[str] = None, error: Optional[str] = None):
+        self.name = name
+        self.label = label
+        self.pattern = pattern
+        self.parse_id = parse_id
+        self.fetch = fetch
+        self.media = media
+        self.resolve = resolve
+        self.source = source or name
+        self.error = error or f'Invalid {label} link format.'
+
+
+# Danh sách sàn và bộ định tuyến: mọi mẫu URL được gộp thành một regex biên dịch sẵn,
+# một lượt quét tin nhắn tìm ra mọi link của mọi sàn
+class MarketplaceRegistry:
+    def __init__(self):
+        self._marketplaces: Dict[str, Marketplace] = {}
+        self._groups: Dict[str, Marketplace] = {}
+        self._router: Optional[re.Pattern] = None
+
+    def register(self, marketplace: Marketplace) -> None:
+        self._marketplaces[marketplace.name] = marketplace
+        self._router = None
+
+    def get(self, name: str) -> Marketplace:
+        return self._marketplaces[name]
+
+    def _compile(self) -> re.Pattern:
+        self._groups = {f'm{i}': marketplace for i, marketplace in enumerate(self._marketplaces.values())}
+        self._router = re.compile('|'.join(f'(?P<{group}>{marketplace.pattern})' for group, marketplace in self._groups.items()), re.IGNORECASE)
+        return self._router
+
+    # Các link sản phẩm trong tin nhắn theo thứ tự xuất hiện, bỏ link trùng sản phẩm
+    def route(self, text: str) -> List[Link]:
+        router = self._router or self._compile()
+        links = {}
+        for match in router.finditer(text):
+            marketplace = self._groups[match.lastgroup]
+            url = match.group().rstrip(TRAILING_PUNCTUATION)
+            item_id = marketplace.parse_id(url)
+            links.setdefault((marketplace.source, item_id or url), Link(marketplace.name, url, item_id))
+        return list(links.values())
+
+
+def query_param(url: str, name: str) -> Optional[str]:
+    values = parse_qs(urlparse(url).query).get(name)
+    return values[0] if values else None
+
+
+def clean_image_url(url: str) -> str:
+    match = re.match(r'(https://.*?(\.jpg|\.jpeg|\.png|\.gif|\.bmp|\.webp|\.mp4))', url)
+    if match:
+        cleaned_url = match.group(1)
+        return cleaned_url
+    return url
+
+
+# Ký tự được xem là một phần của URL trong văn bản hoặc trang HTML. Chữ Hán và dấu câu toàn khổ
+# (thường dính liền sau link trong đoạn chia sẻ từ app) không thuộc URL.
+URL_CHARS = r'[^\s\'"<>\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]'
+
+# Dấu câu ASCII dính sau link trong câu (ví dụ "...?id=1)." hoặc "link: ...?id=1,") không thuộc URL
+TRAILING_PUNCTUATION = '.,;:!?)]}'
+
+_TAOBAO_PATH_ID = re.compile(r'/i(\d+)\.htm')
+_1688_OFFER_ID = re.compile(r'/offer/(\d+)\.html')
+
+
+# Mã sản phẩm Taobao/Tmall: tham số id trong query (không phụ thuộc vị trí), hoặc dạng /i<id>.htm trên a.m.taobao.com
+def parse_taobao_id(url: str) -> Optional[str]:
+    item_id = query_param(url, 'id')
+    if item_id and item_id.isdigit():
+        return item_id
+    match = _TAOBAO_PATH_ID.search(url)
+    return match.group(1) if match else None
+
+
+def parse_1688_id(url: str) -> Optional[str]:
+    match = _1688_OFFER_ID.search(url)
+    return match.group(1) if match else None
+
+
+# Khóa cache cho link PDD: goods_id nếu có, ngược lại là chính URL
+def parse_pdd_id(url: str) -> Optional[str]:
+    return query_param(url, 'goods_id') or url
+
+
+# Gọi một API sản phẩm và đọc JSON trả về. Lỗi mạng, mã trạng thái khác 200 và body không phải
+# JSON object đều thành ProductFetchError để người dùng luôn nhận được câu trả lời.
+async def post_product_api(api: str, api_url: str, payload: dict, error: str) -> dict:
+    try:
+        with UPSTREAM_SECONDS.labels(api).time():
+            response = await http_client.post(api_url, json=payload)
+    except httpx.HTTPError as e:
+        logger.warning('%s request failed: %r', api, e)
+        raise ProductFetchError(error) from e
+    if response.status_code != 200:
+        raise ProductFetchError(error)
+    try:
+        data = response.json()
+    except ValueError as e:
+        logger.warning('%s returned invalid JSON: %s', api, e)
+        raise ProductFetchError(error) from e
+    if not isinstance(data, dict):
+        logger.warning('%s returned %s instead of a JSON object', api, type(data).__name__)
+        raise ProductFetchError(error)
+    return data
+
+
+# Gọi API_TB rồi API2_TB cho một sản phẩm Taobao
+async def fetch_taobao_product(taobao_id: str, url: str) -> tuple:
+    payload = {'id': taobao_id}
+    data = await post_product_api('api_tb', API_TB, payload, 'Failed to fetch image details.')
+    with STAGE_SECONDS.labels('tb_wait').time():
+        await asyncio.sleep(3)
+    data2 = await post_product_api('api2_tb', API2_TB, payload, 'Failed to fetch image desc.')
+    if log_sampled(logger):
+        logger.debug('API2_TB %s: %s', taobao_id, data2)
+    return data, data2
+
+
+def taobao_media(product) -> List[str]:
+    data, data2 = product
+    img_urls = data.get('video', []) + data2.get('descVideos', []) + data.get('images', []) + data.get('skubaseImages', []) + data2.get('descImages', [])
+    if log_sampled(logger):
+        logger.debug('Taobao media: %s', img_urls)
+    return [clean_image_url(img['url']) for img in img_urls if 'url' in img]
+
+
+# Gọi API_PDD cho một sản phẩm Pinduoduo
+async def fetch_pdd_product(goods_id: str, link: str) -> dict:
+    data = await post_product_api('api_pdd', API_PDD, {'linksp': link}, 'Failed to fetch image details.')
+    if log_sampled(logger):
+        logger.debug('API_PDD %s: %s', link, data)
+    return data
+
+
+def pdd_media(data: dict) -> List[str]:
+    img_urls = data.get('topGallery', []) + data.get('viewImage', []) + data.get('detailGalleryUrl', []) + data.get('videoGallery', []) + data.get('liveVideo', [])
+    if log_sampled(logger):
+        logger.debug('PDD media: %s', img_urls)
+    return [clean_image_url(url) for url in img_urls]
+
+
+async def fetch_1688_product(offer_id: str, url: str) -> dict:
+    if not API_1688:
+        raise ProductFetchError('Chưa hỗ trợ link 1688.')
+    return await post_product_api('api_1688', API_1688, {'id': offer_id}, 'Failed to fetch image details.')
+
+
+def product_1688_media(data: dict) -> List[str]:
+    img_urls = data.get('video', []) + data.get('images', []) + data.get('descImages', [])
+    return [clean_image_url(img['url']) for img in img_urls if 'url' in img]
+
+
+# Link sản phẩm (có mã) đầu tiên trong một URL hoặc đoạn văn bản
+def first_product_url(text: str) -> Optional[str]:
+    for link in registry.route(text):
+        if link.item_id:
+            return link.url
+    return None
+
+
+# Phân giải link rút gọn (m.tb.cn, p.pinduoduo.com...) thành link sản phẩm. Mỗi bước dùng HEAD, dừng ngay khi
+# Location đã là link sản phẩm mà không mở trang sản phẩm; trang không chuyển hướng bằng HTTP (m.tb.cn trả về
+# trang HTML chuyển hướng bằng JavaScript) thì chỉ đọc vài chục KB đầu để tìm link sản phẩm.
+# Trả về None nếu không tìm thấy; ném ProductFetchError khi lỗi mạng hoặc quá thời gian (không được cache).
+async def resolve_short_link(url: str) -> Optional[str]:
+    try:
+        return await asyncio.wait_for(_follow_short_link(url), SHORTLINK_TIMEOUT)
+    except (asyncio.TimeoutError, httpx.HTTPError) as e:
+        logger.warning('Resolving short link %s failed: %r', url, e)
+        raise ProductFetchError('Không mở được link rút gọn, vui lòng thử lại sau.') from e
+
+
+async def _follow_short_link(url: str) -> Optional[str]:
+    for _ in range(SHORTLINK_MAX_HOPS):
+        product_url = first_product_url(url)
+        if product_url:
+            return product_url
+        response = await http_client.request('HEAD', url, retry_statuses=(), follow_redirects=False)
+        if response.is_redirect:
+            url = urljoin(url, response.headers['Location'])
+            continue
+        async with http_client.stream('GET', url, retry_statuses=(), follow_redirects=False) as response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers['Location'])
+                continue
+            body = b''
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) >= SHORTLINK_MAX_BYTES:
+                    break
+        return first_product_url(body.decode('utf-8', 'replace'))
+    return None
+
+
+resolve_cache = TTLCache(SHORTLINK_CACHE_TTL, SHORTLINK_CACHE_SIZE, backend=backend, namespace='shortlink:', name='shortlink')
+
+
+# Link có mã sản phẩm: giữ nguyên, hoặc phân giải link rút gọn (có ghi nhớ). None nếu không dùng được.
+async def resolve_link(link: Link) -> Optional[Link]:
+    if link.item_id is not None:
+        return link
+    marketplace = registry.get(link.marketplace)
+    if marketplace.resolve is None:
+        return None
+
+    async def resolve() -> list:
+        product_url = await marketplace.resolve(link.url)
+        resolved = [resolved for resolved in registry.route(product_url) if resolved.item_id] if product_url else []
+        # Chuỗi rỗng: đã phân giải nhưng không ra link sản phẩm, vẫn được ghi nhớ
+        return list(resolved[0]) if resolved else ''
+
+    resolved = await resolve_cache.get_or_fetch(link.url, resolve)
+    return Link(*resolved) if resolved else None
+
+
+registry = MarketplaceRegistry()
+registry.register(Marketplace(
+    'taobao', 'Taobao',
+    r'https?://(?:item|h5\.m|a\.m|m\.intl|world)\.taobao\.com/' + URL_CHARS + '+',
+    parse_taobao_id, fetch_taobao_product, taobao_media, source='tb',
+))
+registry.register(Marketplace(
+    'tmall', 'Tmall',
+    r'https?://(?:detail|detail\.m|chaoshi\.detail)\.tmall\.(?:com|hk)/' + URL_CHARS + '+',
+    parse_taobao_id, fetch_taobao_product, taobao_media, source='tb',
+))
+registry.register(Marketplace(
+    '1688', '1688',
+    r'https?://(?:detail|m)\.1688\.com/offer/\d+\.html' + URL_CHARS + '*',
+    parse_1688_id, fetch_1688_product, product_1688_media,
+))
+registry.register(Marketplace(
+    'pdd', 'Pindoudou',
+    r'https?://(?:mobile\.)?(?:yangkeduo|pinduoduo)\.com/goods\d*\.html' + URL_CHARS + '*',
+    parse_pdd_id, fetch_pdd_product, pdd_media,
+))
+registry.register(Marketplace(
+    'tb_short', 'Taobao',
+    r'https?://(?:m|e|s)\.tb\.cn/' + URL_CHARS + '+',
+    lambda url: None, resolve=resolve_short_link,
+))
+registry.register(Marketplace(
+    'pdd_short', 'Pindoudou',
+    r'https?://p\.(?:pinduoduo|yangkeduo)\.com/' + URL_CHARS + '+',
+    lambda url: None, resolve=resolve_short_link,
+))
+registry.register(Marketplace(
+    '1688_short', '1688',
+    r'https?://qr\.1688\.com/' + URL_CHARS + '+',
+    lambda url: None, resolve=resolve_short_link,
+))
+# Mọi link khác: vẫn là tin nhắn chứa link (không tra cứu mã kiện hàng), trả lời là chưa hỗ trợ.
+# Phải đăng ký cuối cùng để các mẫu cụ thể ở trên được ưu tiên.
+registry.register(Marketplace(
+    'other', 'other',
+    r'https?://' + URL_CHARS + '+',
+    lambda url: None, error='Liên kết này chưa được hỗ trợ.',
+))
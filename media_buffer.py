@@ -0,0 +1,136 @@
+import hashlib
+import io
+import os
+import tempfile
+from typing import BinaryIO, List, Optional
+
+# Kích thước tối đa giữ trong bộ nhớ; lớn hơn (thường là video mp4) sẽ được ghi ra đĩa
+MEDIA_SPILL_BYTES = int(os.getenv('MEDIA_SPILL_BYTES', str(8 * 1024 * 1024)))
+
+
+# Bộ đệm nội dung một media: giữ trong bộ nhớ, chỉ ghi ra tệp tạm khi vượt ngưỡng spill_bytes.
+# Hash sha256 được tính dần trong lúc ghi nên không phải đọc lại nội dung.
+# Sau finish() nội dung trong bộ nhớ là một đối tượng bytes duy nhất: getvalue() trả về chính nó và
+# open() tạo BytesIO dùng chung bộ nhớ đó, không sao chép lại mỗi lần đọc (PIL, nén ảnh, phash, cache, upload).
+# close() đóng mọi handle đã mở và xóa tệp tạm do bộ đệm tạo ra.
+class MediaBuffer:
+    def __init__(self, suffix: str = '', dest_dir: Optional[str] = None, spill_bytes: int = MEDIA_SPILL_BYTES):
+        self.suffix = suffix
+        self.dest_dir = dest_dir
+        self.spill_bytes = spill_bytes
+        self.size = 0
+        self.digest: Optional[str] = None
+        self.path: Optional[str] = None
+        self._owned = True
+        self._memory: Optional[io.BytesIO] = io.BytesIO()
+        self._data: Optional[bytes] = None
+        self._file: Optional[BinaryIO] = None
+        self._hash = hashlib.sha256()
+        self._handles: List[BinaryIO] = []
+
+    # Bộ đệm trỏ tới một tệp có sẵn (ví dụ trong cache), không xóa tệp khi close()
+    @classmethod
+    def from_path(cls, path: str, digest: Optional[str] = None) -> 'MediaBuffer':
+        buffer = cls(os.path.splitext(path)[1])
+        buffer._memory = None
+        buffer._owned = False
+        buffer.path = path
+        buffer.size = os.path.getsize(path)
+        buffer.digest = digest
+        return buffer
+
+    # Bộ đệm trong bộ nhớ từ nội dung có sẵn, giữ digest của nội dung gốc
+    @classmethod
+    def from_bytes(cls, data: bytes, suffix: str = '', digest: Optional[str] = None) -> 'MediaBuffer':
+        buffer = cls(suffix)
+        buffer._memory = None
+        buffer._data = data
+        buffer.size = len(data)
+        buffer.digest = digest
+        return buffer
+
+    @property
+    def in_memory(self) -> bool:
+        return self._memory is not None or self._data is not None
+
+    # Nội dung nằm trong tệp spill do bộ đệm tạo ra (và xóa khi close())
+    @property
+    def owns_file(self) -> bool:
+        return self._owned and self.path is not None and self._file is None
+
+    # Chuyển tệp spill sang đường dẫn khác (ví dụ vào cache media) bằng rename; bộ đệm đọc tiếp từ đó,
+    # handle đã mở vẫn dùng được và close() không còn xóa tệp
+    def move_to(self, path: str) -> None:
+        os.replace(self.path, path)
+        self.path = path
+        self._owned = False
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._memory is not None and self.size > self.spill_bytes:
+            self._spill()
+        (self._file or self._memory).write(chunk)
+
+    def _spill(self) -> None:
+        self._file = tempfile.NamedTemporaryFile(delete=False, suffix=self.suffix, dir=self.dest_dir)
+        self.path = self._file.name
+        self._file.write(self._memory.getbuffer())
+        self._memory.close()
+        self._memory = None
+
+    # Kết thúc ghi: đóng tệp spill (nếu có), chốt nội dung trong bộ nhớ thành bytes (sao chép một lần duy nhất)
+    # và chốt hash nội dung
+    def finish(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._memory is not None:
+            self._data = self._memory.getvalue()
+            self._memory.close()
+            self._memory = None
+        self.digest = self._hash.hexdigest()
+
+    def getvalue(self) -> bytes:
+        if self._data is not None:
+            return self._data
+        if self._memory is not None:
+            return self._memory.getvalue()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    # Mở nội dung để đọc; handle được đóng cùng bộ đệm. BytesIO khởi tạo từ bytes dùng chung bộ nhớ
+    # cho tới khi bị ghi, nên không sao chép nội dung.
+    def open(self) -> BinaryIO:
+        if self._data is not None:
+            handle = io.BytesIO(self._data)
+        elif self._memory is not None:
+            handle = io.BytesIO(self._memory.getvalue())
+        else:
+            handle = open(self.path, 'rb')
+        self._handles.append(handle)
+        return handle
+
+    def close(self) -> None:
+        for handle in self._handles:
+            handle.close()
+        self._handles.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._memory is not None:
+            self._memory.close()
+            self._memory = None
+        self._data = None
+        if self._owned and self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __enter__(self) -> 'MediaBuffer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
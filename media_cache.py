@@ -0,0 +1,314 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from backends import Backend, backend
+from media_buffer import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+# Thư mục lưu tệp media đã tải, tính theo nội dung (sha256)
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'media'))
+# Dung lượng tối đa của thư mục cache, vượt quá thì xóa tệp ít dùng nhất
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# Số file_id tối đa giữ trong chỉ mục, vượt quá thì bỏ file_id ít dùng nhất
+MEDIA_CACHE_MAX_FILE_IDS = int(os.getenv('MEDIA_CACHE_MAX_FILE_IDS', '100000'))
+# Số thay đổi tích lũy trước khi ghi chỉ mục xuống đĩa
+MEDIA_CACHE_SAVE_EVERY = 20
+
+
+# Cache media dùng chung giữa các yêu cầu và giữa các lần khởi động lại:
+# - file_id Telegram theo URL đã làm sạch và theo hash nội dung, để gửi lại không cần tải hay upload
+# - tệp đã tải theo hash nội dung, giới hạn dung lượng và xóa theo LRU
+# file_id còn được ghi vào backend dùng chung (nếu có) để mọi worker cùng dùng lại.
+# URL và hash cảm nhận của một nội dung bị bỏ cùng lúc với tệp của nó, nên chỉ mục không lớn dần theo thời gian.
+class MediaCache:
+    def __init__(self, cache_dir: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_BYTES, shared: Backend = backend,
+                 max_file_ids: int = MEDIA_CACHE_MAX_FILE_IDS):
+        self.shared = shared if shared.shared else None
+        self._shared_writes = set()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        # Thư mục tạm của các job tải media, cùng hệ thống tệp với cache để tệp spill được chuyển vào cache bằng rename
+        self.tmp_dir = os.path.join(cache_dir, 'tmp')
+        # Thứ tự từ ít dùng nhất đến dùng gần nhất
+        self.file_ids: 'OrderedDict[str, str]' = OrderedDict()
+        self.url_digests: Dict[str, str] = {}
+        # digest -> các URL trỏ tới nội dung đó, để bỏ chúng khi tệp bị xóa
+        self._digest_urls: Dict[str, Set[str]] = {}
+        # digest -> hash cảm nhận của ảnh, dùng để bỏ ảnh gần trùng kể cả khi gửi lại bằng file_id
+        self.phashes: Dict[str, int] = {}
+        # digest -> (tên tệp, kích thước), thứ tự từ ít dùng nhất đến dùng gần nhất
+        self.files: 'OrderedDict[str, tuple]' = OrderedDict()
+        self.total_bytes = 0
+        self._changes = 0
+        self._saving: Optional[asyncio.Task] = None
+        self._writing: Dict[str, asyncio.Task] = {}
+        # digest -> số media đang dùng tệp (đang chờ gửi hoặc đang gửi); tệp đang được dùng không bị xóa
+        self._pins: Dict[str, int] = {}
+
+    def load(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Thư mục tạm còn sót lại từ lần chạy trước bị dừng đột ngột
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read media cache index %s: %s', self.index_path, e)
+            return
+
+        self.file_ids = OrderedDict(index.get('file_ids', {}))
+        for digest, name, size in index.get('files', []):
+            if os.path.exists(os.path.join(self.cache_dir, name)):
+                self.files[digest] = (name, size)
+                self.total_bytes += size
+        # Chỉ giữ URL và hash cảm nhận của nội dung còn tệp trên đĩa
+        for url, digest in index.get('url_digests', {}).items():
+            if digest in self.files:
+                self._put_url_digest(url, digest)
+        self.phashes = {digest: phash for digest, phash in index.get('phashes', {}).items() if digest in self.files}
+        self._trim_file_ids()
+        logger.info('Loaded media cache: %d file_ids, %d files, %d bytes', len(self.file_ids), len(self.files), self.total_bytes)
+
+    # Chụp chỉ mục trên event loop (tránh đọc dict đang bị sửa), mã hóa và ghi tệp trong thread riêng
+    async def save(self) -> None:
+        if self._saving is not None:
+            await asyncio.gather(self._saving, return_exceptions=True)
+        self._changes = 0
+        await asyncio.to_thread(self._write_index, self._index())
+
+    def _index(self) -> dict:
+        return {
+            'file_ids': dict(self.file_ids),
+            'url_digests': dict(self.url_digests),
+            'phashes': dict(self.phashes),
+            'files': [[digest, name, size] for digest, (name, size) in self.files.items()],
+        }
+
+    def _write_index(self, index: dict) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _changed(self) -> None:
+        self._changes += 1
+        # Lượt ghi trước chưa xong thì để lượt thay đổi sau ghi tiếp
+        if self._changes < MEDIA_CACHE_SAVE_EVERY or self._saving is not None:
+            return
+        self._saving = asyncio.get_running_loop().create_task(self._save_in_background())
+
+    async def _save_in_background(self) -> None:
+        try:
+            self._changes = 0
+            await asyncio.to_thread(self._write_index, self._index())
+        except OSError as e:
+            logger.warning('Could not save media cache index: %s', e)
+        finally:
+            self._saving = None
+
+    # file_id đã upload cho URL, hoặc cho nội dung trùng hash với URL đó
+    def get_file_id(self, url: str) -> Optional[str]:
+        file_id = self._get_file_id('url:' + url)
+        if file_id is None and url in self.url_digests:
+            file_id = self._get_file_id('sha256:' + self.url_digests[url])
+        return file_id
+
+    def get_file_id_by_digest(self, digest: str) -> Optional[str]:
+        return self._get_file_id('sha256:' + digest)
+
+    def _get_file_id(self, key: str) -> Optional[str]:
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            self.file_ids.move_to_end(key)
+        return file_id
+
+    def _trim_file_ids(self) -> None:
+        while len(self.file_ids) > self.max_file_ids:
+            self.file_ids.popitem(last=False)
+
+    # Như get_file_id nhưng hỏi thêm backend dùng chung khi trong process chưa có
+    async def lookup_file_id(self, url: str) -> Optional[str]:
+        file_id = self.get_file_id(url)
+        if file_id is None and self.shared is not None:
+            file_id = await self.shared.get('fileid:url:' + url)
+            if file_id is not None:
+                self.file_ids['url:' + url] = file_id
+                self._trim_file_ids()
+        return file_id
+
+    async def lookup_file_id_by_digest(self, digest: str) -> Optional[str]:
+        file_id = self.get_file_id_by_digest(digest)
+        if file_id is None and self.shared is not None:
+            file_id = await self.shared.get('fileid:sha256:' + digest)
+            if file_id is not None:
+                self.file_ids['sha256:' + digest] = file_id
+                self._trim_file_ids()
+        return file_id
+
+    def put_file_id(self, url: str, digest: Optional[str], file_id: str) -> None:
+        keys = ['url:' + url]
+        if digest:
+            keys.append('sha256:' + digest)
+        for key in keys:
+            self.file_ids[key] = file_id
+            self.file_ids.move_to_end(key)
+            if self.shared is not None:
+                task = asyncio.get_running_loop().create_task(self.shared.set('fileid:' + key, file_id))
+                self._shared_writes.add(task)
+                task.add_done_callback(self._shared_writes.discard)
+        self._trim_file_ids()
+        self._changed()
+
+    # Bỏ file_id Telegram đã từ chối (tệp bị xóa phía server, bot đổi server Bot API...) theo URL và theo hash nội dung,
+    # cả trong process và trong backend dùng chung, để lần gửi sau upload lại. Khóa đã trỏ sang file_id khác thì giữ nguyên.
+    async def drop_file_id(self, url: str, digest: Optional[str], file_id: str) -> None:
+        keys = ['url:' + url]
+        if digest:
+            keys.append('sha256:' + digest)
+        for key in keys:
+            if self.file_ids.get(key) == file_id:
+                del self.file_ids[key]
+            if self.shared is not None and await self.shared.get('fileid:' + key) == file_id:
+                await self.shared.delete('fileid:' + key)
+        self._changed()
+
+    def get_phash(self, digest: Optional[str]) -> Optional[int]:
+        return self.phashes.get(digest) if digest else None
+
+    def put_phash(self, digest: str, phash: int) -> None:
+        self.phashes[digest] = phash
+        self._changed()
+
+    # Đường dẫn tệp đã lưu cho URL nếu còn trong cache
+    def get_path(self, url: str) -> Optional[str]:
+        digest = self.url_digests.get(url)
+        if digest is None or digest not in self.files:
+            return None
+        self.files.move_to_end(digest)
+        return os.path.join(self.cache_dir, self.files[digest][0])
+
+    def get_digest(self, url: str) -> Optional[str]:
+        return self.url_digests.get(url)
+
+    # Thư mục tạm cho một job tải media
+    def make_temp_dir(self) -> str:
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return tempfile.mkdtemp(dir=self.tmp_dir)
+
+    # Giữ tệp của digest trong cache cho tới khi unpin(): media gửi bằng đường dẫn (server Bot API ở chế độ
+    # --local) hoặc đọc từ tệp trong cache không bị mất tệp khi job khác thêm tệp lớn vào cache
+    def pin(self, digest: Optional[str]) -> None:
+        if digest:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest: Optional[str]) -> None:
+        count = self._pins.get(digest, 0)
+        if count <= 1:
+            self._pins.pop(digest, None)
+            self._evict()
+        else:
+            self._pins[digest] = count - 1
+
+    # Lưu nội dung bộ đệm vào cache theo hash. Bộ đệm trong bộ nhớ được ghi nền, không nằm trên
+    # đường gửi; tệp spill được chuyển hẳn vào cache (rename, không sao chép) và bộ đệm đọc tiếp từ đó.
+    async def add(self, url: str, buffer: MediaBuffer) -> None:
+        digest = buffer.digest
+        self._put_url_digest(url, digest)
+        self._changed()
+        if digest in self.files:
+            self.files.move_to_end(digest)
+            return
+        if digest in self._writing:
+            return
+        name = digest + buffer.suffix
+        if buffer.in_memory:
+            task = asyncio.get_running_loop().create_task(self._store(digest, name, buffer.getvalue()))
+            self._writing[digest] = task
+            task.add_done_callback(lambda t: self._writing.pop(digest, None))
+        elif buffer.owns_file:
+            await self._store(digest, name, buffer)
+        else:
+            await self._store(digest, name, buffer.path)
+
+    async def _store(self, digest: str, name: str, source) -> None:
+        try:
+            size = await asyncio.to_thread(self._write_file, name, source)
+        except OSError as e:
+            logger.warning('Could not cache media %s: %s', name, e)
+            if digest not in self.files:
+                self._forget(digest)
+            return
+        if digest not in self.files:
+            self.files[digest] = (name, size)
+            self.total_bytes += size
+            self._evict()
+
+    # Ghi vào tệp tạm rồi đổi tên để không bao giờ để lại tệp ghi dở trong cache.
+    # Tệp spill của bộ đệm được chuyển thẳng vào cache; khác hệ thống tệp thì sao chép.
+    def _write_file(self, name: str, source) -> int:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached_path = os.path.join(self.cache_dir, name)
+        if isinstance(source, MediaBuffer):
+            try:
+                source.move_to(cached_path)
+                return source.size
+            except OSError:
+                source = source.path
+        tmp_path = cached_path + '.tmp'
+        if isinstance(source, bytes):
+            with open(tmp_path, 'wb') as f:
+                f.write(source)
+        else:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, cached_path)
+        return os.path.getsize(cached_path)
+
+    def _evict(self) -> None:
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Xóa theo LRU, bỏ qua tệp đang được dùng; luôn giữ lại tệp vừa thêm dù nó lớn hơn giới hạn
+        newest = next(reversed(self.files), None)
+        for digest in list(self.files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if digest == newest or digest in self._pins:
+                continue
+            name, size = self.files.pop(digest)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            self._forget(digest)
+            logger.info('Evicted cached media %s (%d bytes)', name, size)
+
+    def _put_url_digest(self, url: str, digest: str) -> None:
+        previous = self.url_digests.get(url)
+        if previous is not None and previous != digest:
+            self._digest_urls.get(previous, set()).discard(url)
+        self.url_digests[url] = digest
+        self._digest_urls.setdefault(digest, set()).add(url)
+
+    # Bỏ các URL và hash cảm nhận trỏ tới nội dung không còn tệp; file_id theo URL vẫn giữ
+    # (tới giới hạn số file_id) vì gửi lại bằng file_id không cần tệp
+    def _forget(self, digest: str) -> None:
+        for url in self._digest_urls.pop(digest, ()):
+            if self.url_digests.get(url) == digest:
+                del self.url_digests[url]
+        self.phashes.pop(digest, None)
+
+
+media_cache = MediaCache()
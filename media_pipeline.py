@@ -0,0 +1,527 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse, urlsplit, urlunsplit
+
+from telegram import InputFile, InputMediaPhoto, InputMediaVideo
+
+from bot_api import bot_api
+from http_client import http_client
+from image_probe import PROBE_MAX_BYTES, image_size
+from image_transcode import image_transcoder, is_near_duplicate
+from media_buffer import MediaBuffer
+from media_cache import media_cache
+from metrics import CACHE_EVENTS, MEDIA_DOWNLOAD_BYTES, MEDIA_DOWNLOAD_SECONDS, MEDIA_SKIPPED, MEDIA_VALIDATE_SECONDS
+from ttl_cache import TTLCache
+from video_probe import VideoInfo, make_thumbnail, probe_mp4
+
+logger = logging.getLogger(__name__)
+
+# Số lượt tải media đồng thời tối đa (toàn cục và theo từng host CDN)
+MEDIA_CONCURRENCY = int(os.getenv('MEDIA_CONCURRENCY', '8'))
+MEDIA_PER_HOST = int(os.getenv('MEDIA_PER_HOST', '4'))
+# Số tệp được phép tải trước so với tệp đang chờ gửi
+MEDIA_PREFETCH = int(os.getenv('MEDIA_PREFETCH', '18'))
+# Số nhóm media đã sẵn sàng được giữ trong hàng đợi chờ gửi
+MEDIA_QUEUE_SIZE = int(os.getenv('MEDIA_QUEUE_SIZE', '2'))
+# Telegram cho phép tối đa 10 media mỗi album, bot gửi theo nhóm 9 ảnh
+MEDIA_GROUP_SIZE = 9
+# Ảnh có cạnh nhỏ hơn ngưỡng này bị bỏ qua
+MIN_IMAGE_SIZE = 200
+# Cache kích thước ảnh theo URL, ảnh quá nhỏ sẽ bị bỏ qua mà không cần gửi request
+PROBE_CACHE_TTL = float(os.getenv('PROBE_CACHE_TTL', str(24 * 3600)))
+PROBE_CACHE_SIZE = int(os.getenv('PROBE_CACHE_SIZE', '20000'))
+
+# Bỏ ảnh gần trùng (theo hash cảm nhận) trong cùng một lượt gửi: số bit dHash và độ lệch màu (0-255) tối đa
+IMAGE_DEDUPE = os.getenv('IMAGE_DEDUPE', '1') == '1'
+IMAGE_DEDUPE_DISTANCE = int(os.getenv('IMAGE_DEDUPE_DISTANCE', '6'))
+IMAGE_DEDUPE_COLOR_DIFF = int(os.getenv('IMAGE_DEDUPE_COLOR_DIFF', '24'))
+
+# Giới hạn upload; tệp lớn hơn (thường là video) được gửi dưới dạng liên kết thay vì tải về.
+# Bỏ trống để dùng giới hạn của server Bot API đang dùng (50 MB, hoặc 2000 MB với server tự host ở chế độ --local).
+MEDIA_MAX_UPLOAD_BYTES = int(os.getenv('MEDIA_MAX_UPLOAD_BYTES') or '0')
+# Video ngắn hơn ngưỡng này (giây) được gom chung album với ảnh; video dài hơn gửi riêng
+VIDEO_GROUP_MAX_SECONDS = int(os.getenv('VIDEO_GROUP_MAX_SECONDS', '60'))
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+
+# Tệp vượt giới hạn upload, phát hiện từ Content-Length hoặc trong lúc tải
+class MediaTooLarge(Exception):
+    def __init__(self, size: int):
+        super().__init__(f'{size} bytes exceeds the upload limit')
+        self.size = size
+
+
+# Một media hợp lệ, sẵn sàng gửi: nội dung trong bộ đệm hoặc file_id đã upload trước đó.
+# kind 'link' là tệp quá lớn để upload, chỉ gửi URL (size là dung lượng theo Content-Length).
+class DownloadedMedia:
+    __slots__ = ('url', 'buffer', 'kind', 'digest', 'file_id', 'phash', 'video', 'thumbnail', 'size', 'pinned')
+
+    def __init__(self, url: str, buffer: Optional[MediaBuffer], kind: str, digest: Optional[str] = None, file_id: Optional[str] = None, phash: Optional[int] = None,
+                 video: Optional[VideoInfo] = None, thumbnail: Optional[bytes] = None, size: Optional[int] = None):
+        self.url = url
+        self.buffer = buffer
+        self.kind = kind
+        self.digest = digest
+        self.file_id = file_id
+        self.phash = phash
+        self.video = video
+        self.thumbnail = thumbnail
+        self.size = size
+        # digest của tệp trong cache media được giữ lại cho tới khi media được đóng
+        self.pinned: Optional[str] = None
+
+    @property
+    def is_video(self) -> bool:
+        return self.kind == 'video'
+
+    @property
+    def is_link(self) -> bool:
+        return self.kind == 'link'
+
+    # Video đủ ngắn để gom chung album với ảnh; video không đọc được thời lượng được gửi riêng
+    @property
+    def groupable(self) -> bool:
+        if not self.is_video:
+            return not self.is_link
+        if self.file_id is not None:
+            return True
+        return self.video is not None and self.video.duration is not None and self.video.duration <= VIDEO_GROUP_MAX_SECONDS
+
+    # Giữ tệp trong cache cho tới khi gửi xong (xem MediaCache.pin)
+    def pin(self) -> 'DownloadedMedia':
+        if self.pinned is None and self.digest:
+            media_cache.pin(self.digest)
+            self.pinned = self.digest
+        return self
+
+    def close(self) -> None:
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.pinned is not None:
+            media_cache.unpin(self.pinned)
+            self.pinned = None
+
+
+def media_extension(url: str) -> str:
+    # Xóa các tham số query rồi lấy phần mở rộng của file từ URL
+    base_filename = os.path.basename(urlparse(url).path).split('?')[0]
+    return os.path.splitext(base_filename)[1]
+
+
+# Hậu tố kích thước CDN thêm sau tên tệp gốc, ví dụ .jpg_430x430q90.jpg hoặc .jpg_.webp
+_SIZE_SUFFIX = re.compile(r'(\.(?:jpe?g|png|gif|webp))_(?:\d+x\d+(?:q\d+)?)?\.(?:jpe?g|png|webp)$', re.IGNORECASE)
+
+
+# URL ảnh gốc: bỏ hậu tố kích thước của CDN và thêm https cho URL dạng //host/...
+def canonical_media_url(url: str) -> str:
+    if url.startswith('//'):
+        url = 'https:' + url
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc.lower(), _SIZE_SUFFIX.sub(r'\1', parts.path), parts.query, ''))
+
+
+# Tham số query xử lý ảnh của CDN (Aliyun OSS x-oss-process, imageView2/imageMogr2 của ảnh PDD):
+# chỉ đổi kích thước/định dạng, không đổi ảnh gốc
+_PROCESSING_QUERY = re.compile(r'^(?:x-oss-process|imageView2|imageMogr2|imageslim)\b', re.IGNORECASE)
+
+
+# Bỏ URL trùng sau khi chuẩn hóa, giữ thứ tự xuất hiện. Các bản cùng ảnh chỉ khác tham số xử lý ảnh
+# hoặc khác http/https được xem là trùng; các tham số query khác (chữ ký, id) vẫn phân biệt ảnh.
+# URL trả về đã bỏ tham số xử lý ảnh, tức là ảnh gốc thay vì bản thu nhỏ (có thể bị loại vì quá nhỏ).
+def dedupe_media_urls(urls: Iterable[str]) -> List[str]:
+    unique = {}
+    for url in urls:
+        parts = urlsplit(canonical_media_url(url))
+        query = '&'.join(param for param in parts.query.split('&') if param and not _PROCESSING_QUERY.match(param))
+        url = urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+        unique.setdefault((parts.netloc, parts.path, query), url)
+    return list(unique.values())
+
+
+def is_too_small(size: Tuple[int, int]) -> bool:
+    return size[0] < MIN_IMAGE_SIZE or size[1] < MIN_IMAGE_SIZE
+
+
+# Chỉ dùng khi không đọc được kích thước từ header; Pillow được import ở lần dùng đầu tiên
+def read_image_size(buffer: MediaBuffer) -> Tuple[int, int]:
+    from PIL import Image
+
+    with Image.open(buffer.open()) as img:
+        return img.size
+
+
+probe_cache = TTLCache(PROBE_CACHE_TTL, PROBE_CACHE_SIZE, name='probe')
+
+
+# Bộ tải media song song có giới hạn số kết nối toàn cục và theo host
+class MediaDownloader:
+    def __init__(self, concurrency: int = MEDIA_CONCURRENCY, per_host: int = MEDIA_PER_HOST):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self._global_limit: Optional[asyncio.Semaphore] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    # Semaphore được tạo trong event loop đang chạy
+    def _limits(self, url: str):
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self.concurrency)
+        host = urlparse(url).netloc
+        host_limit = self._host_limits.get(host)
+        if host_limit is None:
+            host_limit = self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._global_limit, host_limit
+
+    # Tải nhiều URL cùng lúc, trả kết quả theo đúng thứ tự URL đầu vào (None nếu tải thất bại).
+    # Chỉ tối đa prefetch tệp được tải trước so với kết quả đang chờ lấy ra.
+    async def iter_fetch(self, media_urls: Iterable[str], dest_dir: str, prefetch: int = MEDIA_PREFETCH) -> AsyncIterator[Optional[DownloadedMedia]]:
+        pending = deque()
+        remaining = iter(media_urls)
+        try:
+            while True:
+                while len(pending) < prefetch:
+                    media_url = next(remaining, None)
+                    if media_url is None:
+                        break
+                    pending.append(asyncio.ensure_future(self.fetch(media_url, dest_dir)))
+                if not pending:
+                    return
+                yield await pending.popleft()
+        finally:
+            # Hủy và chờ các lượt tải còn lại; media đã tải xong nhưng chưa được lấy ra thì đóng bộ đệm
+            for task in pending:
+                task.cancel()
+            for media in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(media, DownloadedMedia):
+                    media.close()
+
+    async def fetch(self, media_url: str, dest_dir: str) -> Optional[DownloadedMedia]:
+        kind = 'video' if media_extension(media_url) == '.mp4' else 'image'
+
+        # Đã upload trước đó: gửi lại bằng file_id, không tải cũng không upload
+        file_id = await media_cache.lookup_file_id(media_url)
+        if file_id is not None:
+            CACHE_EVENTS.labels('media', 'file_id').inc()
+            digest = media_cache.get_digest(media_url)
+            return DownloadedMedia(media_url, None, kind, digest, file_id, media_cache.get_phash(digest))
+
+        # Tệp đã được tải và kiểm tra trước đó vẫn còn trong cache
+        cached_path = media_cache.get_path(media_url)
+        if cached_path is not None:
+            CACHE_EVENTS.labels('media', 'disk').inc()
+            digest = media_cache.get_digest(media_url)
+            media_cache.pin(digest)
+            buffer = MediaBuffer.from_path(cached_path, digest)
+            try:
+                if kind == 'video':
+                    media = await self._video(media_url, buffer, digest)
+                else:
+                    media = DownloadedMedia(media_url, buffer, kind, digest, phash=await self._phash(buffer))
+                # Giữ tệp trước khi bỏ lượt giữ tạm, để không có lúc nào tệp có thể bị xóa
+                media.pin()
+            finally:
+                media_cache.unpin(digest)
+            return media
+
+        # Ảnh đã biết là quá nhỏ từ lần thăm dò trước
+        size = probe_cache.get(media_url)
+        if kind == 'image' and size is not None and is_too_small(size):
+            CACHE_EVENTS.labels('probe', 'hit').inc()
+            MEDIA_SKIPPED.labels('too_small').inc()
+            logger.debug('Image %s is too small (cached probe), skipping.', media_url)
+            return None
+
+        CACHE_EVENTS.labels('media', 'miss').inc()
+        global_limit, host_limit = self._limits(media_url)
+        try:
+            # Chờ suất của host trước: tệp đang chờ một host bận không giữ suất toàn cục của các host khác
+            async with host_limit, global_limit:
+                started = time.monotonic()
+                buffer = await self._download(media_url, dest_dir, probe=(kind == 'image'))
+        except MediaTooLarge as e:
+            MEDIA_SKIPPED.labels('too_large').inc()
+            logger.info('Media %s is too large to upload (%d bytes), sending a link instead.', media_url, e.size)
+            return DownloadedMedia(media_url, None, 'link', size=e.size)
+        except Exception as e:
+            MEDIA_SKIPPED.labels('download_error').inc()
+            logger.error('Exception occurred while downloading media: %s, error: %s', media_url, str(e))
+            return None
+        if buffer is None:
+            return None
+        MEDIA_DOWNLOAD_SECONDS.labels(kind).observe(time.monotonic() - started)
+        MEDIA_DOWNLOAD_BYTES.labels(kind).observe(buffer.size)
+
+        # Chỉ mở ảnh bằng PIL khi không đọc được kích thước từ header
+        if kind == 'image' and probe_cache.get(media_url) is None:
+            try:
+                # Mở ảnh bằng PIL trong thread riêng để không chặn event loop
+                with MEDIA_VALIDATE_SECONDS.labels('pil').time():
+                    size = await asyncio.to_thread(read_image_size, buffer)
+            except Exception as e:
+                MEDIA_SKIPPED.labels('invalid').inc()
+                logger.error('Error checking image size for %s: %s', media_url, str(e))
+                buffer.close()
+                return None
+            probe_cache.set(media_url, size)
+            if is_too_small(size):
+                MEDIA_SKIPPED.labels('too_small').inc()
+                logger.debug('Image %s is too small, skipping.', media_url)
+                buffer.close()
+                return None
+
+        # Nội dung trùng với media đã upload thì không cần nén lại
+        file_id = await media_cache.lookup_file_id_by_digest(buffer.digest)
+        if file_id is None and kind == 'image':
+            buffer = await self._transcode(buffer)
+
+        media_cache.pin(buffer.digest)
+        try:
+            await media_cache.add(media_url, buffer)
+            if kind == 'video':
+                media = await self._video(media_url, buffer, buffer.digest, file_id)
+            else:
+                media = DownloadedMedia(media_url, buffer, kind, buffer.digest, file_id, await self._phash(buffer))
+            media.pin()
+        finally:
+            media_cache.unpin(buffer.digest)
+        return media
+
+    # Thời lượng, kích thước khung hình và thumbnail để Telegram hiển thị video ngay, không phải
+    # chờ xử lý phía server. Video đã có file_id thì Telegram đã biết các thông tin này.
+    async def _video(self, media_url: str, buffer: MediaBuffer, digest: Optional[str], file_id: Optional[str] = None) -> DownloadedMedia:
+        if file_id is not None:
+            return DownloadedMedia(media_url, buffer, 'video', digest, file_id)
+        with MEDIA_VALIDATE_SECONDS.labels('video_probe').time():
+            with buffer.open() as handle:
+                info = await asyncio.to_thread(probe_mp4, handle, buffer.size)
+        if info is None:
+            logger.debug('Video %s has no readable MP4 header.', media_url)
+        with MEDIA_VALIDATE_SECONDS.labels('thumbnail').time():
+            thumbnail = await make_thumbnail(buffer.path, None if buffer.path else buffer.getvalue())
+        return DownloadedMedia(media_url, buffer, 'video', digest, video=info, thumbnail=thumbnail)
+
+    # Hash cảm nhận theo digest nội dung gốc, được lưu trong media_cache để không tính lại
+    async def _phash(self, buffer: MediaBuffer) -> Optional[int]:
+        if not IMAGE_DEDUPE:
+            return None
+        phash = media_cache.get_phash(buffer.digest)
+        if phash is None:
+            with MEDIA_VALIDATE_SECONDS.labels('phash').time():
+                phash = await image_transcoder.phash(buffer.getvalue())
+            if phash is not None:
+                media_cache.put_phash(buffer.digest, phash)
+        return phash
+
+    # Nén lại ảnh trong process pool; bộ đệm mới giữ digest của nội dung gốc để cache vẫn khớp
+    async def _transcode(self, buffer: MediaBuffer) -> MediaBuffer:
+        with MEDIA_VALIDATE_SECONDS.labels('transcode').time():
+            data = await image_transcoder.transcode(buffer.getvalue(), MIN_IMAGE_SIZE)
+        if data is None:
+            return buffer
+        buffer.close()
+        return MediaBuffer.from_bytes(data, '.jpg', buffer.digest)
+
+    # Tải vào bộ đệm (bộ nhớ, hoặc tệp tạm trong dest_dir nếu quá lớn). Với ảnh, kích thước được
+    # đọc từ vài KB đầu trong lúc stream; ảnh quá nhỏ bị hủy trước khi tải phần thân còn lại.
+    # Tệp vượt giới hạn upload (theo Content-Length, hoặc khi đang tải nếu server không báo) ném MediaTooLarge.
+    async def _download(self, media_url: str, dest_dir: str, probe: bool = False) -> Optional[MediaBuffer]:
+        max_bytes = MEDIA_MAX_UPLOAD_BYTES or bot_api.max_upload_bytes
+        # Client dùng chung tự thử lại có jitter khi gặp mã 420 hoặc lỗi kết nối
+        async with http_client.stream('GET', media_url, headers={'User-Agent': USER_AGENT}) as response:
+            logger.debug('Media URL %s response status: %d', media_url, response.status_code)
+            if response.status_code != 200:
+                MEDIA_SKIPPED.labels(f'http_{response.status_code}').inc()
+                return None
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise MediaTooLarge(int(content_length))
+            header = b''
+            rejected = False
+            buffer = MediaBuffer(media_extension(media_url), dest_dir)
+            try:
+                async for chunk in response.aiter_bytes():
+                    if probe:
+                        header += chunk
+                        size = image_size(header)
+                        if size is not None or len(header) >= PROBE_MAX_BYTES:
+                            probe = False
+                            header = b''
+                        if size is not None:
+                            probe_cache.set(media_url, size)
+                            if is_too_small(size):
+                                rejected = True
+                                break
+                    buffer.write(chunk)
+                    if buffer.size > max_bytes:
+                        raise MediaTooLarge(buffer.size)
+                buffer.finish()
+            except BaseException:
+                buffer.close()
+                raise
+        if rejected:
+            MEDIA_SKIPPED.labels('too_small').inc()
+            logger.debug('Image %s is too small, skipping before full download.', media_url)
+            buffer.close()
+            return None
+        logger.debug('Downloaded %s (%d bytes, %s)', media_url, buffer.size, 'memory' if buffer.in_memory else 'spilled to disk')
+        return buffer
+
+
+media_downloader = MediaDownloader()
+
+
+# Nội dung truyền cho InputMedia*: file_id nếu đã upload trước đó; đường dẫn tệp trong cache media khi dùng
+# server Bot API tự host ở chế độ --local (server tự đọc tệp, bot không upload); ngược lại là handle đọc bộ đệm
+# (được đóng khi media.close()). Video được stream thẳng từ handle lúc upload thay vì đọc hết vào bộ nhớ.
+def media_input(media: DownloadedMedia):
+    if media.file_id is not None:
+        return media.file_id
+    path = bot_api.file_input(media_cache.get_path(media.url))
+    if path is not None:
+        return path
+    if media.is_video:
+        filename = os.path.basename(urlparse(media.url).path) or 'video.mp4'
+        # attach: bắt buộc khi tệp nằm trong InputMedia của album, gửi riêng cũng dùng được
+        return InputFile(media.buffer.open(), filename=filename, attach=True, read_file_handle=False)
+    return media.buffer.open()
+
+
+# Tham số hiển thị cho video: thời lượng, kích thước, thumbnail và phát khi đang tải
+def video_options(media: DownloadedMedia) -> dict:
+    options = {'supports_streaming': True}
+    if media.video is not None:
+        options.update(duration=media.video.duration, width=media.video.width or None, height=media.video.height or None)
+    if media.thumbnail is not None:
+        options['thumbnail'] = media.thumbnail
+    return options
+
+
+# Phần tử album cho sendMediaGroup: ảnh, hoặc video ngắn kèm thông tin hiển thị
+def input_media(media: DownloadedMedia):
+    if media.is_video:
+        return InputMediaVideo(media_input(media), **video_options(media))
+    return InputMediaPhoto(media_input(media))
+
+
+# Ghi nhớ file_id Telegram trả về sau lần upload đầu tiên để các lần sau gửi lại bằng file_id
+def remember_sent(media: DownloadedMedia, message) -> None:
+    if media.file_id is not None or message is None:
+        return
+    if media.is_video:
+        attachment = message.video
+    else:
+        attachment = message.photo[-1] if message.photo else None
+    if attachment is not None:
+        media_cache.put_file_id(media.url, media.digest, attachment.file_id)
+
+
+# Telegram từ chối một lượt gửi có dùng file_id đã lưu: bỏ các file_id đó khỏi cache rồi lấy lại nội dung
+# (từ tệp trong cache media hoặc tải lại) để upload mới. Media cũ được đóng; media không lấy lại được thì bị bỏ.
+async def refetch_without_file_ids(media_group: List[DownloadedMedia], dest_dir: str) -> List[DownloadedMedia]:
+    refetched = []
+    try:
+        for media in media_group:
+            if media.file_id is None:
+                refetched.append(media)
+                continue
+            await media_cache.drop_file_id(media.url, media.digest, media.file_id)
+            media.close()
+            fresh = await media_downloader.fetch(media.url, dest_dir)
+            if fresh is not None:
+                refetched.append(fresh)
+    except BaseException:
+        for media in refetched:
+            media.close()
+        raise
+    return refetched
+
+
+# Bỏ các ảnh gần trùng với ảnh đã gặp trước đó trong cùng lượt (giữ bản xuất hiện đầu tiên)
+async def drop_near_duplicates(media_iter: AsyncIterator[Optional[DownloadedMedia]]) -> AsyncIterator[Optional[DownloadedMedia]]:
+    seen: List[int] = []
+    async for media in media_iter:
+        if media is not None and media.phash is not None:
+            if any(is_near_duplicate(media.phash, phash, IMAGE_DEDUPE_DISTANCE, IMAGE_DEDUPE_COLOR_DIFF) for phash in seen):
+                MEDIA_SKIPPED.labels('duplicate').inc()
+                logger.debug('Image %s is a near-duplicate, skipping.', media.url)
+                media.close()
+                continue
+            seen.append(media.phash)
+        yield media
+
+
+# Gom media theo thứ tự: ảnh và video ngắn được gom thành album tối đa group_size,
+# video dài và liên kết video quá lớn là một nhóm riêng
+async def iter_media_groups(media_iter: AsyncIterator[Optional[DownloadedMedia]], group_size: int = MEDIA_GROUP_SIZE) -> AsyncIterator[List[DownloadedMedia]]:
+    album = []
+    try:
+        async for media in media_iter:
+            if media is None:
+                continue
+            if not media.groupable:
+                yield [media]
+                continue
+            album.append(media)
+            if len(album) == group_size:
+                group, album = album, []
+                yield group
+        if album:
+            group, album = album, []
+            yield group
+    finally:
+        # Album chưa đủ nhóm khi bị dừng giữa chừng: bên gọi không nhận được nên đóng tại đây
+        for media in album:
+            media.close()
+
+
+# Producer/consumer: việc tải chạy nền và đẩy từng nhóm vào hàng đợi có giới hạn,
+# bên gọi nhận nhóm đầu tiên ngay khi nó sẵn sàng
+async def stream_media_groups(media_urls: List[str], dest_dir: str, queue_size: int = MEDIA_QUEUE_SIZE) -> AsyncIterator[List[DownloadedMedia]]:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    # Producer kết thúc bằng None, hoặc đẩy lỗi của nó cho bên gọi ném lại.
+    # Các generator được đóng từ ngoài vào trong để mọi bộ đệm và lượt tải dở được dọn ngay khi producer dừng.
+    async def produce() -> None:
+        media_iter = media_downloader.iter_fetch(media_urls, dest_dir)
+        unique_iter = drop_near_duplicates(media_iter)
+        groups = iter_media_groups(unique_iter)
+        try:
+            async for media_group in groups:
+                try:
+                    await queue.put(media_group)
+                except BaseException:
+                    for media in media_group:
+                        media.close()
+                    raise
+        except Exception as e:
+            await queue.put(e)
+            return
+        finally:
+            await groups.aclose()
+            await unique_iter.aclose()
+            await media_iter.aclose()
+        await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            media_group = await queue.get()
+            if media_group is None:
+                break
+            if isinstance(media_group, Exception):
+                raise media_group
+            yield media_group
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        # Đóng bộ đệm của các nhóm đã tải nhưng chưa được gửi
+        while not queue.empty():
+            media_group = queue.get_nowait()
+            if isinstance(media_group, list):
+                for media in media_group:
+                    media.close()
@@ -0,0 +1,53 @@
+import logging
+import os
+import random
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+
+# Cổng HTTP riêng cho /metrics khi chạy polling hoặc worker (chế độ webhook dùng chung web server); 0 để tắt
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8080'))
+# Tỉ lệ yêu cầu được ghi log chi tiết ở mức DEBUG (danh sách URL, payload API)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+
+# Bucket cho kích thước tệp media: 16 KB .. 64 MB
+BYTE_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(8))
+
+# Thời gian từng giai đoạn xử lý một yêu cầu: gọi API sản phẩm, chờ giữa API_TB và API2_TB,
+# tra cứu mã kiện hàng, tải và gửi media, toàn bộ job...
+STAGE_SECONDS = Histogram('tbcn_stage_seconds', 'Time spent in each request stage', ['stage'])
+UPSTREAM_SECONDS = Histogram('tbcn_upstream_seconds', 'Upstream API latency', ['api'])
+MEDIA_DOWNLOAD_SECONDS = Histogram('tbcn_media_download_seconds', 'Per-media download time', ['kind'])
+MEDIA_DOWNLOAD_BYTES = Histogram('tbcn_media_download_bytes', 'Per-media downloaded size', ['kind'], buckets=BYTE_BUCKETS)
+MEDIA_VALIDATE_SECONDS = Histogram('tbcn_media_validate_seconds', 'Image validation and transcode time', ['step'])
+SEND_SECONDS = Histogram('tbcn_telegram_send_seconds', 'Telegram send/upload time, including rate-limit waits', ['method'])
+
+CACHE_EVENTS = Counter('tbcn_cache_events_total', 'Cache lookups by cache and result', ['cache', 'result'])
+HTTP_RETRY_EVENTS = Counter('tbcn_http_retries_total', 'Retried outgoing HTTP requests', ['host', 'reason'])
+HTTP_THROTTLED = Counter('tbcn_http_throttled_total', 'Responses with status 420/429 from upstreams', ['host', 'status'])
+MEDIA_SKIPPED = Counter('tbcn_media_skipped_total', 'Media skipped before sending', ['reason'])
+TELEGRAM_RETRY_AFTER = Counter('tbcn_telegram_retry_after_total', 'RetryAfter responses from Telegram')
+# Ảnh qua bước nén lại (đã nén lại hoặc giữ nguyên) và tổng dung lượng trước/sau, để tính dung lượng tiết kiệm được
+IMAGE_TRANSCODE_IMAGES = Counter('tbcn_image_transcode_images_total', 'Images passed through the transcode step', ['result'])
+IMAGE_TRANSCODE_BYTES = Counter('tbcn_image_transcode_bytes_total', 'Image bytes before (in) and after (out) the transcode step', ['direction'])
+
+JOBS_PENDING = Gauge('tbcn_jobs_pending', 'Jobs waiting in the local scheduler')
+JOBS_RUNNING = Gauge('tbcn_jobs_running', 'Jobs running in the local scheduler')
+# Thời gian khởi động theo giai đoạn (import, warm-up, tổng tới khi sẵn sàng) và trạng thái sẵn sàng nhận update
+STARTUP_SECONDS = Gauge('tbcn_startup_seconds', 'Time spent in each startup phase of this process', ['phase'])
+READY = Gauge('tbcn_ready', '1 once warm-up finished and the process accepts updates or jobs')
+
+
+# Có ghi log chi tiết cho lượt này không; luôn False khi logger không bật DEBUG
+def log_sampled(logger: logging.Logger) -> bool:
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE
+
+
+# Nội dung cho endpoint /metrics: (body, content type)
+def render_metrics() -> tuple:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int = METRICS_PORT) -> None:
+    if port:
+        start_http_server(port)
+        logging.getLogger(__name__).info('Metrics server listening on port %d', port)
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Awaitable, Callable, Hashable
+
+from telegram.error import RetryAfter
+
+from metrics import SEND_SECONDS, TELEGRAM_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+# Giới hạn gửi của Telegram: khoảng 30 tin/giây trên toàn bot, khoảng 1 tin/giây mỗi chat riêng
+# và 20 tin/phút mỗi nhóm. Burst cho phép gửi dồn vài tin trước khi phải chờ.
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_GLOBAL_BURST = float(os.getenv('SEND_GLOBAL_BURST', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', str(20 / 60)))
+SEND_GROUP_BURST = float(os.getenv('SEND_GROUP_BURST', '5'))
+# Số lần gửi lại khi Telegram trả về RetryAfter
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', '3'))
+# Số bucket theo chat được giữ lại, chat ít dùng nhất bị bỏ trước
+SEND_MAX_CHATS = 10000
+
+
+# Token bucket: nạp rate token mỗi giây, tối đa burst token; pause() chặn hẳn trong một khoảng thời gian
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Số giây cần chờ trước khi có đủ token; 0 nghĩa là đã lấy được.
+    # Lượt tốn hơn burst được lấy khi bucket đầy và để số token âm, các lượt sau chờ trả đủ phần thiếu.
+    def try_acquire(self, cost: float = 1) -> float:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    async def acquire(self, cost: float = 1) -> None:
+        while True:
+            delay = self.try_acquire(cost)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+# Số tin Telegram tính cho một lời gọi: album tính theo số media trong đó
+def send_cost(func: Callable[..., Awaitable], args: tuple, kwargs: dict) -> int:
+    if not getattr(func, '__name__', '').endswith('media_group'):
+        return 1
+    media = kwargs.get('media', args[0] if args else None)
+    return max(1, len(media)) if media is not None else 1
+
+
+# Bộ lập lịch gửi tin ra Telegram: mọi lời gọi reply_* đi qua đây. Tin trong cùng một chat
+# được gửi tuần tự theo token bucket của chat đó, các chat khác nhau gửi song song,
+# tất cả cùng chia bucket toàn cục. Tự chờ và gửi lại khi Telegram trả về RetryAfter.
+class SendScheduler:
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST)
+        self._chats: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+
+    def _chat(self, chat_id: Hashable) -> tuple:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Chat nhóm có id âm
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(SEND_GROUP_RATE, SEND_GROUP_BURST)
+            else:
+                bucket = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            chat = self._chats[chat_id] = (bucket, asyncio.Lock())
+            while len(self._chats) > SEND_MAX_CHATS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return chat
+
+    async def send(self, chat_id: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        bucket, lock = self._chat(chat_id)
+        with SEND_SECONDS.labels(getattr(func, '__name__', 'send')).time():
+            return await self._send(chat_id, bucket, lock, func, *args, **kwargs)
+
+    async def _send(self, chat_id: Hashable, bucket: TokenBucket, lock: asyncio.Lock, func: Callable[..., Awaitable], *args, **kwargs):
+        cost = send_cost(func, args, kwargs)
+        async with lock:
+            attempt = 0
+            while True:
+                await bucket.acquire(cost)
+                await self.global_bucket.acquire(cost)
+                try:
+                    return await func(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt >= SEND_RETRIES:
+                        raise
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    TELEGRAM_RETRY_AFTER.inc()
+                    logger.warning('Flood control for chat %s, retrying in %s s', chat_id, retry_after)
+                    bucket.pause(retry_after)
+                    attempt += 1
+
+    # Bọc một hàm reply_* để mọi lời gọi đi qua bộ lập lịch
+    def bind(self, chat_id: Hashable, func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        async def scheduled(*args, **kwargs):
+            return await self.send(chat_id, func, *args, **kwargs)
+        return scheduled
+
+
+send_scheduler = SendScheduler()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+
+import bot  # noqa: E402
+import media_pipeline  # noqa: E402
+from media_pipeline import DownloadedMedia  # noqa: E402
+
+
+class Message:
+    def __init__(self, file_id):
+        self.photo = [type('PhotoSize', (), {'file_id': file_id})()]
+
+
+class FakeBuffer:
+    def __init__(self):
+        self.closed = False
+
+    def open(self):
+        return b'jpeg'
+
+    def close(self):
+        self.closed = True
+
+
+# Telegram từ chối file_id đã lưu: bot bỏ file_id đó và gửi lại album bằng upload mới
+def test_rejected_file_id_is_uploaded_again(monkeypatch, tmp_path):
+    async def main():
+        monkeypatch.setattr(bot.media_cache, 'tmp_dir', str(tmp_path))
+        monkeypatch.setattr(bot.media_cache, 'file_ids', OrderedDict())
+        bot.media_cache.put_file_id('https://cdn.test/a.jpg', 'aaa', 'stale')
+        created = []
+
+        async def fetch(media_url, dest_dir):
+            file_id = await bot.media_cache.lookup_file_id(media_url)
+            media = DownloadedMedia(media_url, None if file_id else FakeBuffer(), 'image', 'aaa', file_id)
+            created.append(media)
+            return media
+
+        monkeypatch.setattr(media_pipeline.media_downloader, 'fetch', fetch)
+        sent = []
+
+        async def reply_media_group(media):
+            sent.append([item.media for item in media])
+            if any(item.media == 'stale' for item in media):
+                raise BadRequest('Wrong file identifier/http url specified')
+            return [Message(f'new-{i}') for i in range(len(media))]
+
+        replies = []
+
+        async def reply(text):
+            replies.append(text)
+
+        await bot.download_and_send_media(None, ['https://cdn.test/a.jpg', 'https://cdn.test/b.jpg'], reply, None, reply_media_group)
+
+        assert len(sent) == 2
+        assert 'stale' not in sent[1]
+        assert replies[-1] == 'Gửi tin nhắn hoàn tất.'
+        assert bot.media_cache.get_file_id('https://cdn.test/a.jpg') == 'new-0'
+        assert all(media.buffer is None or media.buffer.closed for media in created)
+
+    asyncio.run(main())
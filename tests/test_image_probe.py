@@ -0,0 +1,51 @@
+import io
+
+import pytest
+from PIL import Image
+
+from image_probe import image_size
+
+SIZE = (321, 123)
+
+
+def encode(mode: str, format: str, **params) -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, SIZE, (10, 20, 30, 40)[:len(mode)]).save(output, format, **params)
+    return output.getvalue()
+
+
+SAMPLES = {
+    'jpeg-baseline': lambda: encode('RGB', 'JPEG'),
+    'jpeg-progressive': lambda: encode('RGB', 'JPEG', progressive=True),
+    'jpeg-exif': lambda: encode('RGB', 'JPEG', exif=b'Exif\x00\x00' + b'\x00' * 20000),
+    'png': lambda: encode('RGB', 'PNG'),
+    'gif': lambda: encode('P', 'GIF'),
+    'webp-vp8': lambda: encode('RGB', 'WEBP'),
+    'webp-vp8l': lambda: encode('RGB', 'WEBP', lossless=True),
+    'webp-vp8x': lambda: encode('RGBA', 'WEBP'),
+}
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_image_size(name):
+    data = SAMPLES[name]()
+    if name == 'jpeg-progressive':
+        assert b'\xff\xc2' in data
+    if name.startswith('webp-'):
+        assert data[12:16] == {'webp-vp8': b'VP8 ', 'webp-vp8l': b'VP8L', 'webp-vp8x': b'VP8X'}[name]
+    assert image_size(data) == SIZE
+
+
+# Phần đầu tệp bị cắt ở bất kỳ vị trí nào: hoặc chưa đủ dữ liệu (None), hoặc đã đọc đúng kích thước
+@pytest.mark.parametrize('name', SAMPLES)
+def test_truncated_input(name):
+    data = SAMPLES[name]()
+    results = {image_size(data[:length]) for length in range(min(len(data), 30000))}
+    assert results <= {None, SIZE}
+    assert image_size(data[:8]) is None
+
+
+def test_unknown_format():
+    assert image_size(b'') is None
+    assert image_size(b'BM' + b'\x00' * 100) is None
+    assert image_size(b'\xff\xd8\x00\x00garbage') is None
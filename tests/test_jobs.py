@@ -0,0 +1,47 @@
+import asyncio
+
+from jobs import JobScheduler
+
+
+def test_stop_with_running_job():
+    async def main():
+        scheduler = JobScheduler(workers=2)
+        await scheduler.start()
+        started = asyncio.Event()
+
+        async def run():
+            started.set()
+            await asyncio.sleep(60)
+
+        job = scheduler.submit(1, 'link', run)
+        await started.wait()
+        assert not await scheduler.drain(0.2)
+        await asyncio.wait_for(scheduler.stop(), 3)
+        assert job.task.cancelled()
+        assert scheduler.running_count == 0
+
+    asyncio.run(main())
+
+
+def test_superseded_job_keeps_worker_running():
+    async def main():
+        scheduler = JobScheduler(workers=1)
+        await scheduler.start()
+        started = asyncio.Event()
+        done = []
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(60)
+
+        async def fast():
+            done.append(True)
+
+        scheduler.submit(1, 'link', slow)
+        await started.wait()
+        scheduler.submit(1, 'link', fast, supersede=True)
+        assert await scheduler.drain(1)
+        assert done == [True]
+        await asyncio.wait_for(scheduler.stop(), 3)
+
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import pytest
+
+from marketplaces import Link, registry
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('https://item.taobao.com/item.htm?spm=a21n57.1.0.0.2b2a523c&id=712345678901&ns=1&abbucket=9',
+     Link('taobao', 'https://item.taobao.com/item.htm?spm=a21n57.1.0.0.2b2a523c&id=712345678901&ns=1&abbucket=9', '712345678901')),
+    ('https://a.m.taobao.com/i712345678901.htm?spm=a2141.7631565',
+     Link('taobao', 'https://a.m.taobao.com/i712345678901.htm?spm=a2141.7631565', '712345678901')),
+    ('https://detail.tmall.com/item.htm?id=612345678901&skuId=5012345',
+     Link('tmall', 'https://detail.tmall.com/item.htm?id=612345678901&skuId=5012345', '612345678901')),
+    ('https://detail.1688.com/offer/654321987654.html?spm=a26352.13672862',
+     Link('1688', 'https://detail.1688.com/offer/654321987654.html?spm=a26352.13672862', '654321987654')),
+    ('https://mobile.yangkeduo.com/goods1.html?goods_id=401234567890&page_from=23',
+     Link('pdd', 'https://mobile.yangkeduo.com/goods1.html?goods_id=401234567890&page_from=23', '401234567890')),
+    ('https://example.com/x', Link('other', 'https://example.com/x', None)),
+])
+def test_route_single_link(text, expected):
+    assert registry.route(text) == [expected]
+
+
+def test_short_link_in_chinese_share_text():
+    text = '【淘宝】https://m.tb.cn/h.5Abc123?tk=XyZ9 CZ0001 「夏季新款连衣裙」点击链接直接打开'
+    assert registry.route(text) == [Link('tb_short', 'https://m.tb.cn/h.5Abc123?tk=XyZ9', None)]
+    text = '复制这条信息https://p.pinduoduo.com/AbCd1234，打开拼多多'
+    assert registry.route(text) == [Link('pdd_short', 'https://p.pinduoduo.com/AbCd1234', None)]
+
+
+def test_several_links_in_one_message():
+    text = ('so sánh https://item.taobao.com/item.htm?id=1 với https://detail.tmall.com/item.htm?id=2\n'
+            'và https://detail.1688.com/offer/3.html, trùng: https://item.taobao.com/item.htm?ns=1&id=1')
+    assert registry.route(text) == [
+        Link('taobao', 'https://item.taobao.com/item.htm?id=1', '1'),
+        Link('tmall', 'https://detail.tmall.com/item.htm?id=2', '2'),
+        Link('1688', 'https://detail.1688.com/offer/3.html', '3'),
+    ]
+
+
+@pytest.mark.parametrize('suffix', ['.', ',', ')', ').', '!', '?', ';', ':'])
+def test_trailing_punctuation_is_stripped(suffix):
+    text = f'(xem https://item.taobao.com/item.htm?id=1{suffix} nhé'
+    assert registry.route(text) == [Link('taobao', 'https://item.taobao.com/item.htm?id=1', '1')]
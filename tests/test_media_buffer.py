@@ -0,0 +1,28 @@
+import os
+
+from media_buffer import MediaBuffer
+
+
+def test_memory_buffer_is_not_copied_on_read():
+    buffer = MediaBuffer(spill_bytes=1024)
+    buffer.write(b'a' * 100)
+    buffer.write(b'b' * 100)
+    buffer.finish()
+    assert buffer.in_memory
+    assert buffer.getvalue() is buffer.getvalue()
+    assert buffer.open().read() == b'a' * 100 + b'b' * 100
+    buffer.close()
+    assert not buffer.in_memory
+
+
+def test_spill_and_move(tmp_path):
+    buffer = MediaBuffer('.mp4', str(tmp_path), spill_bytes=10)
+    buffer.write(b'x' * 64)
+    buffer.finish()
+    assert not buffer.in_memory and buffer.owns_file
+    handle = buffer.open()
+    target = str(tmp_path / 'cached.mp4')
+    buffer.move_to(target)
+    assert handle.read() == b'x' * 64
+    buffer.close()
+    assert os.path.exists(target)
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import media_pipeline
+from media_pipeline import DownloadedMedia, dedupe_media_urls
+
+
+def test_dedupe_keeps_the_unprocessed_image():
+    urls = [
+        'https://img.pddpic.com/a.jpeg?imageView2/2/w/100',
+        'https://img.pddpic.com/a.jpeg',
+        '//img.alicdn.com/b.jpg_430x430q90.jpg',
+        'http://img.alicdn.com/b.jpg?x-oss-process=image/resize,w_100',
+    ]
+    assert dedupe_media_urls(urls) == ['https://img.pddpic.com/a.jpeg', 'https://img.alicdn.com/b.jpg']
+
+
+def test_dedupe_keeps_content_identifying_query():
+    urls = ['https://cdn.test/c.jpg?sig=1', 'https://cdn.test/c.jpg?sig=2', 'https://cdn.test/c.jpg?sig=1&x-oss-process=image/resize,w_100']
+    assert dedupe_media_urls(urls) == ['https://cdn.test/c.jpg?sig=1', 'https://cdn.test/c.jpg?sig=2']
+
+
+class FakeBuffer:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_teardown_closes_everything(monkeypatch):
+    async def main():
+        created = []
+        running = set()
+
+        async def fetch(media_url, dest_dir):
+            running.add(media_url)
+            try:
+                await asyncio.sleep(0.01 * (int(media_url) % 5))
+                media = DownloadedMedia(media_url, FakeBuffer(), 'image')
+                created.append(media)
+                return media
+            finally:
+                running.discard(media_url)
+
+        monkeypatch.setattr(media_pipeline.media_downloader, 'fetch', fetch)
+        groups = media_pipeline.stream_media_groups([str(i) for i in range(60)], '/nonexistent')
+        received = []
+        with pytest.raises(RuntimeError):
+            try:
+                async for group in groups:
+                    received.extend(group)
+                    # Bên gửi lỗi giữa chừng, như khi Telegram từ chối album
+                    raise RuntimeError('send failed')
+            finally:
+                await groups.aclose()
+        for media in received:
+            media.close()
+
+        assert not running
+        assert created
+        assert all(media.buffer.closed for media in created)
+
+    asyncio.run(main())
+
+
+def test_refetch_drops_rejected_file_ids(monkeypatch, tmp_path):
+    fakeredis = pytest.importorskip('fakeredis')
+    from backends import RedisBackend
+    from media_cache import MediaCache
+
+    async def main():
+        shared = RedisBackend(client=fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()))
+        cache = MediaCache(str(tmp_path), shared=shared)
+        cache.load()
+        monkeypatch.setattr(media_pipeline, 'media_cache', cache)
+        cache.put_file_id('https://cdn.test/a.jpg', 'aaa', 'stale')
+        cache.put_file_id('https://cdn.test/b.jpg', 'bbb', 'fresh')
+        await asyncio.gather(*cache._shared_writes)
+
+        async def fetch(media_url, dest_dir):
+            assert await cache.lookup_file_id(media_url) is None
+            return DownloadedMedia(media_url, FakeBuffer(), 'image', 'aaa')
+
+        monkeypatch.setattr(media_pipeline.media_downloader, 'fetch', fetch)
+        rejected = DownloadedMedia('https://cdn.test/a.jpg', None, 'image', 'aaa', 'stale')
+        uploaded = DownloadedMedia('https://cdn.test/c.jpg', FakeBuffer(), 'image', 'ccc')
+        group = await media_pipeline.refetch_without_file_ids([rejected, uploaded], str(tmp_path))
+
+        assert [media.url for media in group] == ['https://cdn.test/a.jpg', 'https://cdn.test/c.jpg']
+        assert group[0].file_id is None and group[0].buffer is not None
+        assert group[1] is uploaded
+        assert cache.get_file_id('https://cdn.test/a.jpg') is None
+        assert cache.get_file_id_by_digest('aaa') is None
+        assert await shared.get('fileid:url:https://cdn.test/a.jpg') is None
+        assert await shared.get('fileid:sha256:aaa') is None
+        # file_id của media khác không bị ảnh hưởng
+        assert cache.get_file_id('https://cdn.test/b.jpg') == 'fresh'
+        assert await shared.get('fileid:sha256:bbb') == 'fresh'
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+
+import bot  # noqa: E402
+from backends import RedisBackend  # noqa: E402
+from telegram import Bot, Update  # noqa: E402
+from ttl_cache import TTLCache  # noqa: E402
+
+
+# Mỗi backend là một "process": client riêng, dùng chung một Redis giả
+def shared_backends(count: int) -> list:
+    server = fakeredis.FakeServer()
+    return [RedisBackend(client=fakeredis.FakeAsyncRedis(server=server)) for _ in range(count)]
+
+
+def make_update(tg: Bot, update_id: int, chat_id: int, text: str) -> Update:
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'test'},
+            'text': text,
+        },
+    }, tg)
+
+
+def test_shared_cache_fetches_once_across_processes():
+    async def main():
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.3)
+            return {'images': ['a.jpg']}
+
+        caches = [TTLCache(60, 10, backend=backend, namespace='product:') for backend in shared_backends(2)]
+        results = await asyncio.gather(*(cache.get_or_fetch(('tb', '1'), fetch) for cache in caches))
+        assert results == [{'images': ['a.jpg']}] * 2
+        assert len(calls) == 1
+
+    asyncio.run(main())
+
+
+def test_two_consumers_share_the_job_queue(monkeypatch):
+    async def main():
+        ingress, worker = shared_backends(2)
+        tg = Bot('123456:TEST')
+        submitted = []
+        monkeypatch.setattr(bot, 'submit_job', lambda update, handler, text, links: submitted.append((update.update_id, handler, links)) or True)
+
+        # Chat 1 gửi hai link liên tiếp: job của link cũ bị bỏ qua nhờ mốc latest:
+        monkeypatch.setattr(bot, 'backend', ingress)
+        link = bot.marketplaces.route('https://item.taobao.com/item.htm?id=1')
+        await bot.enqueue_shared_job(make_update(tg, 1, 1, 'link 1'), 'link', 'link 1', link)
+        await bot.enqueue_shared_job(make_update(tg, 2, 1, 'link 2'), 'link', 'link 2', link)
+        for update_id in range(3, 7):
+            await bot.enqueue_shared_job(make_update(tg, update_id, update_id, 'TRK000000000001'), 'tracking', 'TRK000000000001', [])
+
+        class Application:
+            pass
+        application = Application()
+        application.bot = tg
+        monkeypatch.setattr(bot, 'backend', worker)
+        consumers = [asyncio.ensure_future(bot.consume_shared_jobs(application)) for _ in range(2)]
+        for _ in range(100):
+            if len(submitted) >= 5:
+                break
+            await asyncio.sleep(0.05)
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+        assert sorted(update_id for update_id, _, _ in submitted) == [2, 3, 4, 5, 6]
+        assert [links for update_id, _, links in submitted if update_id == 2] == [link]
+
+    asyncio.run(main())
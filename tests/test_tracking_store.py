@@ -0,0 +1,52 @@
+import asyncio
+import random
+
+import httpx
+import pytest
+
+from http_client import http_client
+from tracking_store import NGRAM, TrackingFetchError, TrackingSnapshot, TrackingStore
+
+
+# Cách tra cứu cũ: quét toàn bộ sheet
+def scan(rows: list, query: str) -> list:
+    return [item for item in rows if query in str(item.get('tracking'))]
+
+
+def test_lookup_matches_full_scan():
+    rng = random.Random(1)
+    alphabet = 'AB12'
+    rows = [{'tracking': ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 9)))} for _ in range(300)]
+    rows += [{'tracking': None}, {'tracking': 12345}, {'tracking': 1}, {}, {'tracking': 'None'}]
+    snapshot = TrackingSnapshot(rows)
+    queries = ['', 'A', 'B1', 'None', '123', '12345', '23', 'AB12AB12A', 'AB12AB12AB', 'ZZZ']
+    queries += [str(row.get('tracking')) for row in rows[:50]]
+    queries += [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 11))) for _ in range(500)]
+    for query in queries:
+        assert snapshot.lookup(query) == scan(rows, query), query
+
+
+def test_lookup_shortcuts():
+    rows = [{'tracking': 'TRK0001'}, {'tracking': 'TRK0002'}, {'tracking': 'TRK0001'}]
+    snapshot = TrackingSnapshot(rows)
+    # Query dài bằng mã dài nhất: chỉ khớp chính xác, giữ cả các dòng trùng mã
+    assert snapshot.max_key_len == 7
+    assert snapshot.lookup('TRK0001') == [rows[0], rows[2]]
+    assert snapshot.lookup('TRK00011') == []
+    # Query ngắn hơn n-gram được quét trực tiếp
+    assert len('02') < NGRAM
+    assert snapshot.lookup('02') == [rows[1]]
+    assert TrackingSnapshot([]).lookup('x') == []
+
+
+@pytest.mark.parametrize('body', [b'<html>', b'{"rows": []}', b'"x"', b'[1, 2]', b'null'])
+def test_invalid_sheet_raises_fetch_error(body):
+    async def main():
+        http_client._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body)))
+        try:
+            with pytest.raises(TrackingFetchError):
+                await TrackingStore('http://sheet.test/').refresh()
+        finally:
+            await http_client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import ApplicationBuilder
+
+from webhook import SECRET_HEADER, ServerState, create_web_app
+
+SECRET = 'secret'
+
+
+def update_body(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'test'},
+            'text': 'TRK000000000001',
+        },
+    }
+
+
+# Client giả lập Telegram gửi update vào web app của chế độ webhook
+def run_with_client(check) -> None:
+    async def main():
+        application = ApplicationBuilder().token('123456:TEST').updater(None).build()
+        state = ServerState()
+        client = TestClient(TestServer(create_web_app(application, state, path='/telegram', secret=SECRET)))
+        await client.start_server()
+        try:
+            await check(client, application, state)
+        finally:
+            await client.close()
+
+    asyncio.run(main())
+
+
+def test_update_is_queued():
+    async def check(client, application, state):
+        state.ready = True
+        response = await client.post('/telegram', json=update_body(7), headers={SECRET_HEADER: SECRET})
+        assert response.status == 200
+        update = application.update_queue.get_nowait()
+        assert update.update_id == 7
+        assert update.message.text == 'TRK000000000001'
+
+    run_with_client(check)
+
+
+def test_bad_secret_is_rejected():
+    async def check(client, application, state):
+        state.ready = True
+        response = await client.post('/telegram', json=update_body(1), headers={SECRET_HEADER: 'wrong'})
+        assert response.status == 403
+        response = await client.post('/telegram', json=update_body(1))
+        assert response.status == 403
+        assert application.update_queue.empty()
+
+    run_with_client(check)
+
+
+def test_not_ready_or_draining_returns_503():
+    async def check(client, application, state):
+        response = await client.post('/telegram', json=update_body(1), headers={SECRET_HEADER: SECRET})
+        assert response.status == 503
+        assert (await client.get('/health')).status == 503
+        state.ready = True
+        assert (await client.get('/health')).status == 200
+        state.draining = True
+        response = await client.post('/telegram', json=update_body(2), headers={SECRET_HEADER: SECRET})
+        assert response.status == 503
+        assert (await client.get('/health')).status == 503
+        assert application.update_queue.empty()
+
+    run_with_client(check)
+
+
+def test_invalid_update_returns_400():
+    async def check(client, application, state):
+        state.ready = True
+        headers = {SECRET_HEADER: SECRET, 'Content-Type': 'application/json'}
+        for body in ('not json', '[]', '{}', '"x"', 'null', '1'):
+            response = await client.post('/telegram', data=body, headers=headers)
+            assert response.status == 400, body
+        assert application.update_queue.empty()
+
+    run_with_client(check)
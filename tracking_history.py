@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tệp SQLite lưu các mã kiện hàng được theo dõi và trạng thái gần nhất của chúng
+TRACKING_DB = os.getenv('TRACKING_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tracking.db'))
+# Chu kỳ (giây) tải lại sheet và gửi thông báo cho các mã có thay đổi; 0 để tắt
+TRACKING_SYNC_INTERVAL = float(os.getenv('TRACKING_SYNC_INTERVAL', '300'))
+# Số mã tối đa một chat được theo dõi cùng lúc
+TRACKING_MAX_SUBSCRIPTIONS = int(os.getenv('TRACKING_MAX_SUBSCRIPTIONS', '50'))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id INTEGER NOT NULL,
+    sheet TEXT NOT NULL,
+    tracking TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, sheet, tracking)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_tracking ON subscriptions (sheet, tracking);
+CREATE TABLE IF NOT EXISTS tracking_state (
+    sheet TEXT NOT NULL,
+    tracking TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (sheet, tracking)
+);
+CREATE INDEX IF NOT EXISTS tracking_state_tracking ON tracking_state (tracking);
+'''
+
+# Trạng thái của mã không còn ai theo dõi được xóa cùng lượt bỏ theo dõi
+_DELETE_ORPHAN_STATES = '''
+DELETE FROM tracking_state WHERE tracking = ?
+AND NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.sheet = tracking_state.sheet AND s.tracking = tracking_state.tracking)
+'''
+
+_UPSERT_STATE = '''
+INSERT INTO tracking_state (sheet, tracking, state, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (sheet, tracking) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+'''
+
+
+class SubscriptionLimitError(Exception):
+    pass
+
+
+# Trạng thái so sánh của một mã: các trường rec/sl/var của mọi dòng khớp, theo thứ tự trong sheet
+def row_state(rows: list) -> str:
+    return json.dumps([[bool(row.get('rec', False)), row.get('sl'), row.get('var')] for row in rows], ensure_ascii=False)
+
+
+# sheetIndex None (sheet mặc định) được lưu là chuỗi rỗng
+def sheet_key(sheet_index: Optional[str]) -> str:
+    return sheet_index or ''
+
+
+# Lịch sử trạng thái các mã kiện hàng được theo dõi, lưu trong SQLite.
+# Mỗi lượt đồng bộ so trạng thái mới trong sheet với trạng thái đã lưu và chỉ trả về các mã thay đổi.
+# Mọi truy vấn chạy trong thread riêng, dùng chung một kết nối có khóa.
+class TrackingHistory:
+    def __init__(self, path: str = TRACKING_DB, max_subscriptions: int = TRACKING_MAX_SUBSCRIPTIONS):
+        self.path = path
+        self.max_subscriptions = max_subscriptions
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        if self._db is not None:
+            return
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        count = self._db.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0]
+        logger.info('Opened tracking history %s with %d subscriptions', self.path, count)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def _run(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    # Theo dõi một mã và lưu trạng thái người dùng vừa thấy làm mốc so sánh cho lần đồng bộ sau.
+    # Mã đã có người theo dõi giữ mốc cũ để thay đổi chưa đồng bộ vẫn được thông báo cho họ.
+    async def subscribe(self, chat_id: int, sheet_index: Optional[str], tracking: str, rows: list) -> None:
+        await self._run(self._subscribe, chat_id, sheet_key(sheet_index), tracking, row_state(rows))
+
+    def _subscribe(self, chat_id: int, sheet: str, tracking: str, state: str) -> None:
+        with self._db:
+            exists = self._db.execute('SELECT 1 FROM subscriptions WHERE chat_id = ? AND sheet = ? AND tracking = ?', (chat_id, sheet, tracking)).fetchone()
+            if exists is None:
+                count = self._db.execute('SELECT COUNT(*) FROM subscriptions WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+                if count >= self.max_subscriptions:
+                    raise SubscriptionLimitError(f'Bạn chỉ có thể theo dõi tối đa {self.max_subscriptions} mã kiện hàng.')
+            now = time.time()
+            self._db.execute('INSERT OR IGNORE INTO subscriptions (chat_id, sheet, tracking, created_at) VALUES (?, ?, ?, ?)', (chat_id, sheet, tracking, now))
+            self._db.execute('INSERT OR IGNORE INTO tracking_state (sheet, tracking, state, updated_at) VALUES (?, ?, ?, ?)', (sheet, tracking, state, now))
+
+    # Bỏ theo dõi một mã (ở mọi sheet); trả về số mục đã xóa
+    async def unsubscribe(self, chat_id: int, tracking: str) -> int:
+        return await self._run(self._unsubscribe, chat_id, tracking)
+
+    def _unsubscribe(self, chat_id: int, tracking: str) -> int:
+        with self._db:
+            removed = self._db.execute('DELETE FROM subscriptions WHERE chat_id = ? AND tracking = ?', (chat_id, tracking)).rowcount
+            self._db.execute(_DELETE_ORPHAN_STATES, (tracking,))
+        return removed
+
+    # Các mã chat đang theo dõi: danh sách (sheetIndex, mã)
+    async def subscriptions(self, chat_id: int) -> List[Tuple[Optional[str], str]]:
+        rows = await self._run(lambda: self._db.execute('SELECT sheet, tracking FROM subscriptions WHERE chat_id = ? ORDER BY created_at', (chat_id,)).fetchall())
+        return [(sheet or None, tracking) for sheet, tracking in rows]
+
+    # Các sheet có ít nhất một mã được theo dõi
+    async def sheets(self) -> List[Optional[str]]:
+        rows = await self._run(lambda: self._db.execute('SELECT DISTINCT sheet FROM subscriptions').fetchall())
+        return [sheet or None for sheet, in rows]
+
+    # So ảnh chụp sheet mới với trạng thái đã lưu của các mã được theo dõi trong sheet đó.
+    # Trả về danh sách (mã, các dòng hiện tại, các chat theo dõi) cho những mã có rec/sl/var thay đổi.
+    # Mã đã nhận hàng ở mọi dòng được tự động bỏ theo dõi sau khi thông báo.
+    async def sync(self, sheet_index: Optional[str], snapshot) -> List[Tuple[str, list, List[int]]]:
+        return await self._run(self._sync, sheet_key(sheet_index), snapshot)
+
+    def _sync(self, sheet: str, snapshot) -> List[Tuple[str, list, List[int]]]:
+        watched: Dict[str, List[int]] = {}
+        for chat_id, tracking in self._db.execute('SELECT chat_id, tracking FROM subscriptions WHERE sheet = ?', (sheet,)):
+            watched.setdefault(tracking, []).append(chat_id)
+        if not watched:
+            return []
+        known = dict(self._db.execute('SELECT tracking, state FROM tracking_state WHERE sheet = ?', (sheet,)))
+
+        changes = []
+        now = time.time()
+        with self._db:
+            for tracking, chat_ids in watched.items():
+                rows = snapshot.lookup(tracking)
+                state = row_state(rows)
+                if known.get(tracking) == state:
+                    continue
+                self._db.execute(_UPSERT_STATE, (sheet, tracking, state, now))
+                changes.append((tracking, rows, chat_ids))
+                if rows and all(row.get('rec', False) for row in rows):
+                    self._db.execute('DELETE FROM subscriptions WHERE sheet = ? AND tracking = ?', (sheet, tracking))
+                    self._db.execute(_DELETE_ORPHAN_STATES, (tracking,))
+        return changes
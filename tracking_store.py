@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from http_client import http_client
+from metrics import CACHE_EVENTS, UPSTREAM_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Thời gian (giây) dữ liệu sheet được xem là còn mới
+TRACKING_TTL = float(os.getenv('TRACKING_TTL', '60'))
+# Độ dài n-gram dùng cho chỉ mục tìm chuỗi con
+NGRAM = 3
+
+
+class TrackingFetchError(Exception):
+    pass
+
+
+# Ảnh chụp dữ liệu của một sheet cùng các chỉ mục dựng sẵn
+class TrackingSnapshot:
+    __slots__ = ('rows', 'keys', 'exact', 'grams', 'max_key_len', 'etag', 'last_modified', 'fetched_at')
+
+    def __init__(self, rows: list, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.rows = rows
+        self.keys = [str(row.get('tracking')) for row in rows]
+        self.exact: Dict[str, List[int]] = {}
+        self.grams: Dict[str, List[int]] = {}
+        self.max_key_len = 0
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+        for i, key in enumerate(self.keys):
+            self.exact.setdefault(key, []).append(i)
+            self.max_key_len = max(self.max_key_len, len(key))
+            for gram in {key[j:j + NGRAM] for j in range(len(key) - NGRAM + 1)}:
+                self.grams.setdefault(gram, []).append(i)
+
+    # Trả về các dòng có mã kiện hàng chứa chuỗi query, giữ nguyên thứ tự trong sheet
+    def lookup(self, query: str) -> list:
+        # Query dài bằng hoặc hơn mọi mã trong sheet thì chỉ có thể khớp chính xác
+        if len(query) >= self.max_key_len:
+            return [self.rows[i] for i in self.exact.get(query, [])]
+
+        if len(query) < NGRAM:
+            return [row for row, key in zip(self.rows, self.keys) if query in key]
+
+        # Chọn danh sách ứng viên ngắn nhất trong các n-gram của query rồi kiểm tra lại
+        candidates = None
+        for j in range(len(query) - NGRAM + 1):
+            posting = self.grams.get(query[j:j + NGRAM])
+            if posting is None:
+                return []
+            if candidates is None or len(posting) < len(candidates):
+                candidates = posting
+        return [self.rows[i] for i in candidates if query in self.keys[i]]
+
+    # Tra cứu nhiều mã trong một lượt, trả về dict mã -> danh sách dòng khớp (giữ thứ tự mã, bỏ mã trùng)
+    def lookup_many(self, queries: List[str]) -> Dict[str, list]:
+        return {query: self.lookup(query) for query in dict.fromkeys(queries)}
+
+
+# Kho tra cứu mã kiện hàng, lưu trong bộ nhớ theo từng sheetIndex và làm mới nền theo TTL
+class TrackingStore:
+    def __init__(self, api_url: str, ttl: float = TRACKING_TTL):
+        self.api_url = api_url
+        self.ttl = ttl
+        self._snapshots: Dict[Optional[str], TrackingSnapshot] = {}
+        self._inflight: Dict[Optional[str], asyncio.Task] = {}
+
+    # Dữ liệu các sheet đã tải (sheet mặc định có khóa rỗng) để ghi vào ảnh chụp cache
+    def dump(self) -> dict:
+        return {sheet_index or '': {'rows': snapshot.rows, 'etag': snapshot.etag, 'last_modified': snapshot.last_modified}
+                for sheet_index, snapshot in self._snapshots.items()}
+
+    # Nạp lại từ dump(). Dữ liệu nạp lại được xem là đã cũ: tra cứu dùng được ngay, lần get đầu tiên
+    # làm mới ở nền bằng request có điều kiện (thường chỉ nhận 304).
+    def load(self, data: dict) -> None:
+        for sheet_index, item in data.items():
+            snapshot = TrackingSnapshot(item['rows'], item.get('etag'), item.get('last_modified'))
+            snapshot.fetched_at -= self.ttl + 1
+            self._snapshots[sheet_index or None] = snapshot
+        logger.info('Restored %d tracking sheets from snapshot', len(data))
+
+    def url_for(self, sheet_index: Optional[str]) -> str:
+        if sheet_index is not None:
+            return f'{self.api_url}?sheetIndex={sheet_index}'
+        return self.api_url
+
+    async def get(self, sheet_index: Optional[str] = None) -> TrackingSnapshot:
+        snapshot = self._snapshots.get(sheet_index)
+        if snapshot is None:
+            CACHE_EVENTS.labels('tracking', 'miss').inc()
+            return await self.refresh(sheet_index)
+        if time.monotonic() - snapshot.fetched_at > self.ttl:
+            CACHE_EVENTS.labels('tracking', 'stale').inc()
+            if sheet_index not in self._inflight:
+                # Trả dữ liệu cũ ngay, làm mới ở nền
+                self._start_refresh(sheet_index)
+        else:
+            CACHE_EVENTS.labels('tracking', 'hit').inc()
+        return snapshot
+
+    async def lookup(self, tracking_number: str, sheet_index: Optional[str] = None) -> list:
+        snapshot = await self.get(sheet_index)
+        return snapshot.lookup(tracking_number)
+
+    async def refresh(self, sheet_index: Optional[str] = None) -> TrackingSnapshot:
+        task = self._inflight.get(sheet_index) or self._start_refresh(sheet_index)
+        return await asyncio.shield(task)
+
+    def _start_refresh(self, sheet_index: Optional[str]) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self._fetch(sheet_index))
+        self._inflight[sheet_index] = task
+        task.add_done_callback(lambda t: self._on_refreshed(sheet_index, t))
+        return task
+
+    def _on_refreshed(self, sheet_index: Optional[str], task: asyncio.Task) -> None:
+        self._inflight.pop(sheet_index, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning('Refreshing tracking sheet %s failed: %s', sheet_index, task.exception())
+            return
+        self._snapshots[sheet_index] = task.result()
+
+    async def _fetch(self, sheet_index: Optional[str]) -> TrackingSnapshot:
+        previous = self._snapshots.get(sheet_index)
+        headers = {}
+        if previous is not None:
+            if previous.etag:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified:
+                headers['If-Modified-Since'] = previous.last_modified
+        url = self.url_for(sheet_index)
+        try:
+            with UPSTREAM_SECONDS.labels('sheet').time():
+                response = await http_client.get(url, headers=headers)
+        except httpx.HTTPError as e:
+            raise TrackingFetchError(str(e)) from e
+
+        if response.status_code == 304 and previous is not None:
+            CACHE_EVENTS.labels('tracking', 'not_modified').inc()
+            previous.fetched_at = time.monotonic()
+            return previous
+        if response.status_code != 200:
+            raise TrackingFetchError(f'HTTP {response.status_code}')
+
+        # Giải mã JSON và dựng chỉ mục trong thread riêng để không chặn event loop
+        snapshot = await asyncio.to_thread(self._build, response)
+        logger.info('Loaded tracking sheet %s with %d rows', url, len(snapshot.rows))
+        return snapshot
+
+    # Body không phải JSON hoặc không phải danh sách các dòng (object) cũng là lỗi tải sheet
+    @staticmethod
+    def _build(response: httpx.Response) -> TrackingSnapshot:
+        try:
+            rows = response.json()
+        except ValueError as e:
+            raise TrackingFetchError(f'Invalid JSON: {e}') from e
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise TrackingFetchError(f'Unexpected sheet payload: {type(rows).__name__}')
+        return TrackingSnapshot(rows, response.headers.get('ETag'), response.headers.get('Last-Modified'))
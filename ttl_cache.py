@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from backends import Backend
+from metrics import CACHE_EVENTS
+
+_MISSING = object()
+# Thời gian giữ khóa fetch dùng chung giữa các process, và chu kỳ chờ kết quả của process khác
+SHARED_LOCK_TTL = 60
+SHARED_POLL_INTERVAL = 0.2
+
+
+# Cache trong bộ nhớ có TTL và giới hạn số phần tử (xóa phần tử ít dùng nhất),
+# gộp các lời gọi đồng thời cho cùng một khóa thành một lần fetch duy nhất (single-flight).
+# Với backend dùng chung (Redis), giá trị và khóa single-flight được chia sẻ giữa các process.
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int, backend: Optional[Backend] = None, namespace: str = '', name: str = 'ttl'):
+        self.ttl = ttl
+        self.name = name
+        self.maxsize = maxsize
+        self.backend = backend if backend is not None and backend.shared else None
+        self.namespace = namespace
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    # Các phần tử còn hạn dạng [khóa, số giây còn lại, giá trị] để ghi vào ảnh chụp cache (khóa tuple thành list)
+    def dump(self) -> list:
+        now = time.monotonic()
+        return [[list(key) if isinstance(key, tuple) else key, expires_at - now, value]
+                for key, (expires_at, value) in self._data.items() if expires_at > now]
+
+    # Nạp lại từ dump(); elapsed là thời gian đã trôi qua kể từ lúc chụp (ví dụ thời gian bot ngừng chạy)
+    def load(self, items: list, elapsed: float = 0) -> None:
+        now = time.monotonic()
+        for key, remaining, value in items:
+            if remaining > elapsed:
+                self._data[tuple(key) if isinstance(key, list) else key] = (now + remaining - elapsed, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # Trả giá trị trong cache, hoặc gọi fetch() một lần cho mọi bên đang chờ cùng khóa.
+    # Lỗi của fetch được ném lại cho mọi bên chờ và không được lưu vào cache.
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            CACHE_EVENTS.labels(self.name, 'hit').inc()
+            return value
+        task = self._inflight.get(key)
+        if task is not None:
+            CACHE_EVENTS.labels(self.name, 'coalesced').inc()
+        else:
+            task = asyncio.get_running_loop().create_task(self._fetch(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_fetched(key, t))
+        # shield: một bên chờ bị hủy không làm hủy lượt fetch dùng chung
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable]) -> Any:
+        if self.backend is None:
+            CACHE_EVENTS.labels(self.name, 'miss').inc()
+            return await fetch()
+        shared_key = self.namespace + (':'.join(map(str, key)) if isinstance(key, tuple) else str(key))
+        lock_key = shared_key + ':lock'
+        while True:
+            value = await self.backend.get(shared_key)
+            if value is not None:
+                CACHE_EVENTS.labels(self.name, 'shared_hit').inc()
+                return value
+            # Chỉ một process gọi upstream, các process khác chờ kết quả được ghi vào backend
+            if await self.backend.set_if_absent(lock_key, 1, SHARED_LOCK_TTL):
+                CACHE_EVENTS.labels(self.name, 'miss').inc()
+                try:
+                    value = await fetch()
+                    await self.backend.set(shared_key, value, self.ttl)
+                    return value
+                finally:
+                    await self.backend.delete(lock_key)
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+    def _on_fetched(self, key: Hashable, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
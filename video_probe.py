@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import shutil
+import struct
+import tempfile
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+# Ảnh thumbnail theo giới hạn của Telegram: JPEG, cạnh tối đa 320px, dưới 200 KB
+THUMBNAIL_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+# Thời gian tối đa cho một lần chạy ffmpeg tạo thumbnail
+THUMBNAIL_TIMEOUT = float(os.getenv('THUMBNAIL_TIMEOUT', '10'))
+# Đường dẫn ffmpeg (image Docker cài sẵn); để trống nếu không có thì bỏ qua bước tạo thumbnail
+FFMPEG = os.getenv('FFMPEG', shutil.which('ffmpeg') or '')
+
+# Các box MP4 chứa box con cần đi vào khi tìm mvhd/tkhd
+_CONTAINER_BOXES = {b'moov', b'trak'}
+
+
+class VideoInfo:
+    __slots__ = ('duration', 'width', 'height')
+
+    def __init__(self, duration: Optional[int] = None, width: Optional[int] = None, height: Optional[int] = None):
+        self.duration = duration
+        self.width = width
+        self.height = height
+
+
+# Duyệt các box trong khoảng [start, end) của tệp: trả về (loại box, vị trí nội dung, vị trí kết thúc).
+# Chỉ đọc header của box nên bỏ qua được mdat lớn mà không đọc dữ liệu video.
+def _iter_boxes(f: BinaryIO, start: int, end: int):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        body = offset + 8
+        if size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                return
+            size = struct.unpack('>Q', large)[0]
+            body += 8
+        elif size == 0:
+            size = end - offset
+        if size < body - offset:
+            return
+        yield box_type, body, min(offset + size, end)
+        offset += size
+
+
+# Đọc thời lượng (giây) và kích thước khung hình từ box moov/mvhd/tkhd của tệp MP4.
+# Trả về None nếu không phải MP4 hoặc không tìm thấy moov.
+def probe_mp4(f: BinaryIO, size: int) -> Optional[VideoInfo]:
+    info = None
+    stack = [(0, size)]
+    while stack:
+        start, end = stack.pop()
+        for box_type, body, box_end in _iter_boxes(f, start, end):
+            if box_type in _CONTAINER_BOXES:
+                info = info or VideoInfo()
+                stack.append((body, box_end))
+            elif box_type == b'mvhd' and info is not None:
+                f.seek(body)
+                data = f.read(32)
+                if data[:1] == b'\x01' and len(data) >= 32:
+                    timescale, duration = struct.unpack('>IQ', data[20:32])
+                elif len(data) >= 20:
+                    timescale, duration = struct.unpack('>II', data[12:20])
+                else:
+                    continue
+                if timescale:
+                    info.duration = max(1, round(duration / timescale))
+            elif box_type == b'tkhd' and info is not None and not info.width:
+                f.seek(body)
+                data = f.read(96)
+                offset = 88 if data[:1] == b'\x01' else 76
+                if len(data) >= offset + 8:
+                    width, height = struct.unpack('>II', data[offset:offset + 8])
+                    # Kích thước dạng số thực 16.16; track âm thanh có kích thước 0
+                    info.width, info.height = width >> 16, height >> 16
+    return info
+
+
+# Tạo thumbnail JPEG từ khung hình đầu của video bằng ffmpeg. Video trong bộ nhớ được ghi ra tệp tạm trước:
+# MP4 có moov ở cuối tệp không đọc được qua stdin vì ffmpeg cần tua tới moov.
+# Trả về None khi không có ffmpeg, ffmpeg lỗi hoặc ảnh vượt giới hạn của Telegram.
+async def make_thumbnail(path: Optional[str] = None, data: Optional[bytes] = None) -> Optional[bytes]:
+    if not FFMPEG:
+        return None
+    if path is not None:
+        return await _run_ffmpeg(path)
+    try:
+        tmp_path = await asyncio.to_thread(_write_temp, data)
+    except OSError as e:
+        logger.warning('Cannot write video for thumbnail: %s', str(e))
+        return None
+    try:
+        return await _run_ffmpeg(tmp_path)
+    finally:
+        os.remove(tmp_path)
+
+
+def _write_temp(data: bytes) -> str:
+    fd, tmp_path = tempfile.mkstemp(suffix='.mp4')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return tmp_path
+
+
+async def _run_ffmpeg(path: str) -> Optional[bytes]:
+    scale = f'scale={THUMBNAIL_SIDE}:{THUMBNAIL_SIDE}:force_original_aspect_ratio=decrease'
+    command = [FFMPEG, '-v', 'error', '-i', path, '-frames:v', '1', '-vf', scale, '-q:v', '5', '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1']
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError as e:
+        logger.warning('Cannot run ffmpeg for thumbnails: %s', str(e))
+        return None
+    try:
+        thumbnail, _ = await asyncio.wait_for(process.communicate(), THUMBNAIL_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None
+    if process.returncode != 0 or not thumbnail or len(thumbnail) > THUMBNAIL_MAX_BYTES:
+        return None
+    return thumbnail
@@ -0,0 +1,113 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import render_metrics
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình chế độ webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Trạng thái server dùng cho endpoint health
+class ServerState:
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+
+
+# Tạo web app nhận update từ Telegram (hoặc từ client giả lập khi chạy thử cục bộ)
+# và chuyển vào update_queue của application để các handler sẵn có xử lý
+def create_web_app(application: Application, state: ServerState, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET, status=None) -> web.Application:
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            return web.Response(status=403)
+        if state.draining or not state.ready:
+            # Đang warm-up hoặc đang tắt: Telegram sẽ gửi lại update này sau
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        # JSON hợp lệ nhưng không phải update (ví dụ [] hoặc {}) cũng là request sai
+        try:
+            update = Update.de_json(data, application.bot)
+        except (TypeError, AttributeError, KeyError, ValueError):
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        body = {'status': 'draining' if state.draining else ('ok' if state.ready else 'starting')}
+        if status is not None:
+            body.update(status())
+        return web.json_response(body, status=200 if state.ready and not state.draining else 503)
+
+    async def metrics(request: web.Request) -> web.Response:
+        body, content_type = render_metrics()
+        return web.Response(body=body, headers={'Content-Type': content_type})
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    return app
+
+
+# Chạy bot ở chế độ webhook cho tới khi nhận SIGINT/SIGTERM, rồi tắt êm theo đúng thứ tự của run_polling:
+# ngừng nhận update, xử lý nốt update đã nhận, chờ các job đang chạy (post_stop, bot vẫn gửi tin được),
+# đóng bot (shutdown) rồi đóng các tài nguyên còn lại (post_shutdown).
+# Web server mở ngay từ đầu để /health báo 'starting' trong lúc warm-up (post_init); update chỉ được
+# nhận khi đã sẵn sàng.
+async def run_webhook(application: Application, status=None) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    state = ServerState()
+    runner = web.AppRunner(create_web_app(application, state, status=status))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info('Webhook server listening on %s:%d%s', WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+        state.ready = True
+        logger.info('Webhook server ready, accepting updates')
+
+        await stop_event.wait()
+        logger.info('Shutting down webhook server, draining in-flight jobs')
+        state.draining = True
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await runner.cleanup()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
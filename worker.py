@@ -0,0 +1,31 @@
+import asyncio
+import logging
+import signal
+
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+# Chạy process chỉ xử lý job (BOT_ROLE=worker): không nhận update từ Telegram, job được lấy
+# từ hàng đợi dùng chung trong post_init. Khi nhận SIGINT/SIGTERM thì ngừng lấy job,
+# chờ các job đang chạy hoàn tất (trong post_stop, trước khi đóng bot) rồi thoát.
+async def run_worker(application: Application) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        logger.info('Worker started, consuming shared job queue')
+        await stop_event.wait()
+        logger.info('Shutting down worker, draining in-flight jobs')
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)